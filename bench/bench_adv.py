@@ -0,0 +1,98 @@
+# Replays advertising payloads through the ble_advertising parsers on the
+# host and reports packets per second.
+#
+#   python bench/bench_adv.py [scan_log] [repeats]
+#
+# A scan log has one advertisement per line, hex encoded; anything before
+# the last whitespace separated field (address, RSSI, ...) is ignored, as
+# are blank lines and lines starting with '#'. Without a log, a synthetic
+# crowd of flow nodes, phones, beacons and broken packets is used.
+
+import binascii
+import os
+import sys
+import time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(_ROOT, "host"), _ROOT]
+
+import bluetooth
+from ble_advertising import (
+    advertising_payload,
+    decode_name,
+    decode_services,
+    has_uuid128,
+    iter_fields,
+)
+
+_FLOW_UUID = bluetooth.UUID("cf54bd0b-3380-4b9b-b3ec-371dd8b3a7f2")
+
+
+def synthetic():
+    flow_node = bytes(advertising_payload(name=b"beerflow", services=[_FLOW_UUID]))
+    light_node = bytes(
+        advertising_payload(name=b"lednode", services=[bluetooth.UUID(0x181A)])
+    )
+    # Flags, two 16 bit services, a 32 bit one and a name.
+    phone = bytes.fromhex("020106" "050302180f18" "0505aabbccdd" "0709" + b"phone!".hex())
+    # iBeacon: flags and Apple manufacturer data.
+    beacon = bytes.fromhex(
+        "020106" "1aff4c000215" + "00" * 16 + "00010002c5"
+    )
+    truncated = flow_node[:20]
+    zero_padded = light_node + bytes(6)
+    garbage = bytes.fromhex("ff07")
+    return [flow_node, light_node, phone, phone, beacon, beacon, beacon, truncated, zero_padded, garbage]
+
+
+def load(path):
+    packets = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                packets.append(binascii.unhexlify(line.split()[-1]))
+    return packets
+
+
+def walk(packet):
+    for _ in iter_fields(packet):
+        pass
+
+
+def decode(packet):
+    decode_name(packet)
+    decode_services(packet)
+
+
+def prefilter(packet):
+    has_uuid128(packet, bytes(_FLOW_UUID))
+
+
+def bench(name, fn, packets, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for packet in packets:
+            fn(packet)
+    elapsed = time.perf_counter() - start
+    count = repeats * len(packets)
+    print("{:10} {:8} packets in {:.3f}s, {:10.0f} packets/s".format(name, count, elapsed, count / elapsed))
+
+
+def main():
+    args = sys.argv[1:]
+    packets = load(args[0]) if args and not args[0].isdigit() else synthetic()
+    repeats = int(args[-1]) if args and args[-1].isdigit() else 2000
+
+    matches = sum(1 for p in packets if has_uuid128(p, bytes(_FLOW_UUID)))
+    print("{} packets, {} flow nodes".format(len(packets), matches))
+    for packet in packets[:10]:
+        print("  {:<12} {}".format(repr(decode_name(packet)), decode_services(packet)))
+
+    bench("walk", walk, packets, repeats)
+    bench("decode", decode, packets, repeats)
+    bench("prefilter", prefilter, packets, repeats)
+
+
+if __name__ == "__main__":
+    main()
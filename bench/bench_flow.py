@@ -0,0 +1,95 @@
+# Feeds bursts of simulated sensor edges into flow.py on the host and checks
+# that the pulse count and the measured flow rate keep up: every edge must be
+# counted, and the median rate reported while edges come in must be within
+# RATE_TOLERANCE of the real one. Exits non-zero otherwise.
+#
+#   python bench/bench_flow.py [seconds_per_rate]
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import types
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(_ROOT, "host"), _ROOT]
+# flow.py imports network, which has no use on the host.
+sys.modules.setdefault("network", types.ModuleType("network"))
+
+import flow
+
+# The ring holds 32 pulses and ticks are whole milliseconds, so at 2 kHz the
+# instant rate is measured over about 16 ms and is good to a few percent.
+RATE_TOLERANCE = 0.1
+
+
+def feed(pin, rate_hz, seconds, done):
+    # Injects edges in 1 ms slices from a thread, like an IRQ would arrive
+    # while the event loop is busy.
+    total = int(rate_hz * seconds)
+    sent = 0
+    start = time.monotonic()
+    while sent < total:
+        due = min(total, int((time.monotonic() - start) * rate_hz))
+        if due > sent:
+            pin.inject(due - sent)
+            sent = due
+        time.sleep(0.001)
+    done.append(sent)
+
+
+async def run(rate_hz, seconds, hw_counter):
+    flow._counts[0] = 0
+    rates = []
+    meter = flow.FlowMeter()
+    source = flow.setupPins(hw_counter)
+    pin = flow.machine.Pin.pins[flow.SENSOR_PIN]
+    detector = flow.PourDetector(
+        lambda event, m: rates.append((time.perf_counter(), m.rate)), meter, source, 100, 300
+    )
+    task = asyncio.create_task(detector.run())
+    done = []
+    thread = threading.Thread(target=feed, args=(pin, rate_hz, seconds, done))
+    start = time.perf_counter()
+    thread.start()
+    while thread.is_alive():
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0.5)
+    task.cancel()
+    expected_ml_min = rate_hz * 60 * 1000 // meter.k_factor
+    # Steady state: the updates while edges were still coming in, past the
+    # pour start (rate 0) and before the tail where they stop.
+    steady = sorted(rate for t, rate in rates if t - start <= elapsed and rate)
+    measured = steady[len(steady) // 2] if steady else 0
+    ok = (
+        meter.pulses() == done[0]
+        and abs(measured - expected_ml_min) <= expected_ml_min * RATE_TOLERANCE
+    )
+    print(
+        "{:>4} {:6} Hz: sent {:6} counted {:6} in {:.2f}s, rate {:6} ml/min (expected {}) {}".format(
+            "pcnt" if hw_counter else "irq",
+            rate_hz,
+            done[0],
+            meter.pulses(),
+            elapsed,
+            measured,
+            expected_ml_min,
+            "ok" if ok else "FAILED",
+        )
+    )
+    return ok
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    ok = True
+    for hw_counter in (False, True):
+        for rate_hz in (10, 100, 500, 2000):
+            ok &= asyncio.run(run(rate_hz, seconds, hw_counter))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
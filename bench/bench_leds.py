@@ -0,0 +1,97 @@
+# Times the Leds frame engine on the host against the recording NeoPixel
+# stand-in in host/.
+#
+#   python bench/bench_leds.py [number_of_lights] [frames]
+
+import os
+import sys
+import time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(_ROOT, "host"), _ROOT]
+
+import neopixel
+import uasyncio
+import utime
+from leds import EFFECT_OFF, EFFECT_PULSE, FrameBuffer, Leds, T_DELTA, T_STEP, wheel
+
+
+def per_pixel_rainbow(np, n, cycle):
+    for i in range(n):
+        np[i] = wheel(((i * 256 // n) + cycle) & 255)
+
+
+def per_pixel_fill(np, n, color):
+    for i in range(n):
+        np[i] = color
+
+
+def bench(name, fn, frames):
+    start = time.perf_counter()
+    for cycle in range(frames):
+        fn(cycle)
+    elapsed = time.perf_counter() - start
+    print("{:24} {:8.1f} us/frame".format(name, elapsed * 1e6 / frames))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    np = neopixel.NeoPixel(None, n, record=False)
+    frame = FrameBuffer(np, n)
+    # Linear tables so the output is comparable with the per-pixel path.
+    frame.set_brightness(255, gamma=(1, 1, 1))
+
+    bench("fill (per pixel)", lambda c: per_pixel_fill(np, n, (c & 255, 0, 0)), frames)
+    bench("fill (frame buffer)", lambda c: frame.fill(c & 255, 0, 0), frames)
+    bench("rainbow (per pixel)", lambda c: per_pixel_rainbow(np, n, c), frames)
+    bench("rainbow (frame buffer)", lambda c: frame.rainbow(c), frames)
+
+    # Both paths must put the same bytes on the wire.
+    per_pixel_rainbow(np, n, 42)
+    expected = bytes(np.buf)
+    frame.rainbow(42)
+    assert bytes(np.buf) == expected, "rainbow frame mismatch"
+    per_pixel_fill(np, n, (1, 2, 3))
+    expected = bytes(np.buf)
+    frame.fill(1, 2, 3)
+    assert bytes(np.buf) == expected, "fill frame mismatch"
+
+    frame.set_brightness(128)
+    ramp = frame.ramp((145, 105, 0), (255, 230, 164), 90)
+    bench("pulse (ramp lookup)", lambda c: frame.fill_from(ramp, c % 91), frames)
+    start = time.perf_counter()
+    for b in range(16):
+        frame.set_brightness(b * 16)
+    elapsed = time.perf_counter() - start
+    print("{:24} {:8.1f} us/rebuild".format("set_brightness", elapsed * 1e6 / 16))
+
+
+    # One full pulse against the frame scheduler; the wall time should come
+    # out at 2 * T_DELTA however long rendering takes.
+    leds = Leds(n, 27)
+    leds._np.record = False
+    uasyncio.run(pulse(leds))
+    print("stats:", leds.stats())
+
+
+async def pulse(leds):
+    leds.start()
+    # A burst of commands must still leave a single renderer behind.
+    for i in range(100):
+        leds.play(i % 3)
+    leds.play(EFFECT_PULSE)
+    await uasyncio.sleep_ms(0)
+    writes = leds._np.writes
+    start = utime.ticks_ms()
+    await uasyncio.sleep_ms(2 * T_DELTA)
+    elapsed = utime.ticks_diff(utime.ticks_ms(), start)
+    frames = leds._np.writes - writes
+    print("pulse: {} frames in {} ms ({} expected)".format(frames, elapsed, 2 * T_DELTA // T_STEP))
+    leds.play(EFFECT_OFF)
+    await uasyncio.sleep_ms(T_STEP)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Times Pyboard.read_until against a local echo process (cat) through
+# ProcessToSerial, next to the byte-at-a-time reader it replaced.
+#
+#   python bench/bench_pyboard.py [kilobytes ...]
+
+import os
+import sys
+import threading
+import time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+import pyboard
+
+
+def legacy_read_until(pyb, min_num_bytes, ending, timeout=10):
+    # The previous implementation, kept here for comparison.
+    data = pyb.serial.read(min_num_bytes)
+    timeout_count = 0
+    while True:
+        if data.endswith(ending):
+            break
+        elif pyb.serial.inWaiting() > 0:
+            data = data + pyb.serial.read(1)
+            timeout_count = 0
+        else:
+            timeout_count += 1
+            if timeout is not None and timeout_count >= 100 * timeout:
+                break
+            time.sleep(0.01)
+    return data
+
+
+def run(pyb, read_until, size):
+    # Lines of text, like a script's output, then the raw REPL's EOF marker.
+    line = b"0123456789abcdef" * 4 + b"\r\n"
+    payload = line * (size // len(line)) + b"\x04"
+    # Write from a thread: cat blocks once the pipe fills up.
+    writer = threading.Thread(target=pyb.serial.write, args=(payload,))
+    start = time.perf_counter()
+    writer.start()
+    data = read_until(1, b"\x04")
+    elapsed = time.perf_counter() - start
+    writer.join()
+    assert data == payload, (len(data), len(payload))
+    return elapsed
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [16, 64, 256]
+    pyb = pyboard.Pyboard("exec:cat")
+    try:
+        for kb in sizes:
+            size = kb * 1024
+            new = run(pyb, pyb.read_until, size)
+            line = "{:5} KiB: buffered {:8.3f}s {:8.0f} KiB/s".format(kb, new, kb / new)
+            if kb <= 256:
+                old = run(pyb, lambda n, e: legacy_read_until(pyb, n, e), size)
+                line += ", byte at a time {:8.3f}s {:8.0f} KiB/s, {:5.1f}x".format(
+                    old, kb / old, old / new
+                )
+            print(line)
+    finally:
+        pyb.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Checks that flow.Journal restores the latest totals after resets at awkward
+# points: a torn final record, a torn first save, and compaction cut short.
+# Exits non-zero on a mismatch.
+#
+#   python bench/check_journal.py
+
+import os
+import sys
+import tempfile
+import types
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(_ROOT, "host"), _ROOT]
+# flow.py imports network, which has no use on the host.
+sys.modules.setdefault("network", types.ModuleType("network"))
+
+import flow
+
+
+def reboot(path, records=128):
+    # A fresh Journal and meter, with the count lost like after a reset.
+    flow._counts[0] = 0
+    journal = flow.Journal(path, records, min_interval_ms=0)
+    meter = flow.FlowMeter()
+    journal.restore(meter)
+    return journal, meter
+
+
+def save(journal, meter, total):
+    flow._counts[0] = total
+    journal.save(meter, force=True)
+
+
+def tear(path):
+    # Half of a record, as if power went during the write.
+    with open(path, "ab") as f:
+        f.write(b"\x46\x4a\x00\x00\x07\x00\x00\x00\x99\x99")
+
+
+def check(name, meter, want):
+    got = meter.pulses()
+    print("{:40} restored {:4} (want {})".format(name, got, want))
+    return got == want
+
+
+def main():
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "torn")
+        journal, meter = reboot(path)
+        for total in (10, 20, 30):
+            save(journal, meter, total)
+        tear(path + ".0")
+        journal, meter = reboot(path)
+        ok &= check("torn record", meter, 30)
+        for total in (40, 50, 60):
+            save(journal, meter, total)
+        journal, meter = reboot(path)
+        ok &= check("saves after a torn record", meter, 60)
+        save(journal, meter, 70)
+        journal, meter = reboot(path)
+        ok &= check("and after the next reset", meter, 70)
+
+        path = os.path.join(tmp, "first")
+        journal, meter = reboot(path)
+        tear(path + ".0")
+        journal, meter = reboot(path)
+        for total in (20, 30, 40):
+            save(journal, meter, total)
+        journal, meter = reboot(path)
+        ok &= check("saves after a torn first record", meter, 40)
+
+        path = os.path.join(tmp, "compact")
+        journal, meter = reboot(path, records=4)
+        for total in range(1, 11):
+            save(journal, meter, total * 10)
+        journal, meter = reboot(path, records=4)
+        ok &= check("across compactions", meter, 100)
+        # Reset after the new segment was written but before the old one
+        # was removed.
+        old = journal._paths[journal._segment]
+        with open(old, "rb") as f:
+            data = f.read()
+        for total in range(11, 15):
+            save(journal, meter, total * 10)
+        with open(old, "wb") as f:
+            f.write(data)
+        journal, meter = reboot(path, records=4)
+        ok &= check("compaction cut short", meter, 140)
+    print("ok" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
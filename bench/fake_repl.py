@@ -0,0 +1,191 @@
+# A MicroPython raw REPL stand-in, for running pyboard.py against a local
+# process instead of a board:
+#
+#   python pyboard.py -d "exec:python bench/fake_repl.py DEVICE_DIR [STDIN_BUFFER]" -f ls
+#
+# It speaks the raw REPL and raw-paste protocols on stdin/stdout and runs
+# the code it receives with CPython, in DEVICE_DIR as the device's
+# filesystem. With STDIN_BUFFER, input that has not been read yet is capped
+# at that many bytes and the rest dropped, like a board's UART buffer (about
+# 260 bytes on an ESP32). uos, uhashlib, ubinascii, uio, utime and micropython are mapped
+# onto their CPython counterparts, closely enough for pyboard's own helpers.
+
+import binascii
+import hashlib
+import io
+import os
+import sys
+import time
+import traceback
+import types
+
+RAW_BANNER = b"raw REPL; CTRL-B to exit\r\n"
+PASTE_WINDOW = 256
+
+
+class Channel:
+    # Unbuffered stdin shared by the REPL and the code it runs, so neither
+    # reads bytes meant for the other.
+    def __init__(self, fd, limit=None):
+        self._fd = fd
+        self._buf = bytearray()
+        self._limit = limit
+        self.dropped = 0
+
+    def _fill(self):
+        data = os.read(self._fd, 65536)
+        if not data:
+            raise EOFError
+        self._buf += data
+        if self._limit is not None and len(self._buf) > self._limit:
+            self.dropped += len(self._buf) - self._limit
+            del self._buf[self._limit :]
+
+    def read(self, n=1):
+        while len(self._buf) < n:
+            self._fill()
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:] = data
+        return len(data)
+
+    def readline(self):
+        while b"\n" not in self._buf:
+            self._fill()
+        i = self._buf.index(b"\n") + 1
+        data = bytes(self._buf[:i])
+        del self._buf[:i]
+        return data
+
+
+class _Stdin:
+    def __init__(self, channel):
+        self.buffer = channel
+
+    def readline(self):
+        return self.buffer.readline().decode()
+
+    def read(self, n=1):
+        return self.buffer.read(n).decode()
+
+
+class _Stdout:
+    # Text goes out as the board sends it, \n as \r\n; .buffer is raw.
+    def __init__(self, send):
+        self._send = send
+        self.buffer = types.SimpleNamespace(write=send, flush=lambda: None)
+
+    def write(self, s):
+        self._send(s.encode().replace(b"\n", b"\r\n"))
+        return len(s)
+
+    def flush(self):
+        pass
+
+
+def _uos():
+    uos = types.ModuleType("uos")
+    for name in ("chdir", "getcwd", "listdir", "mkdir", "remove", "rename", "rmdir", "stat"):
+        setattr(uos, name, getattr(os, name))
+
+    def ilistdir(path="."):
+        for entry in os.scandir(path or "."):
+            kind = 0x4000 if entry.is_dir() else 0x8000
+            yield entry.name, kind, 0, 0 if entry.is_dir() else entry.stat().st_size
+
+    uos.ilistdir = ilistdir
+    return uos
+
+
+def _install_modules():
+    micropython = types.ModuleType("micropython")
+    micropython.kbd_intr = lambda c: None
+    micropython.const = lambda x: x
+    for name, module in (
+        ("uos", _uos()),
+        ("uhashlib", hashlib),
+        ("ubinascii", binascii),
+        ("uio", io),
+        ("utime", time),
+        ("micropython", micropython),
+    ):
+        sys.modules[name] = module
+
+
+def main():
+    os.chdir(sys.argv[1] if len(sys.argv) > 1 else ".")
+    _install_modules()
+    out = sys.stdout.buffer
+    chan = Channel(sys.stdin.fileno(), int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    sys.stdin = _Stdin(chan)
+    scope = {"__name__": "__main__"}
+
+    def send(data):
+        out.write(data)
+        out.flush()
+
+    def run(code):
+        # Output is sent as it is printed, like on a board.
+        real = sys.stdout
+        sys.stdout = _Stdout(send)
+        err = b""
+        try:
+            exec(compile(code, "<stdin>", "exec"), scope)
+        except BaseException:
+            err = traceback.format_exc().encode()
+        finally:
+            sys.stdout = real
+        send(b"\x04" + err + b"\x04>")
+
+    raw = False
+    code = bytearray()
+    while True:
+        try:
+            c = chan.read(1)
+        except EOFError:
+            return
+        if not raw:
+            if c == b"\x01":
+                raw = True
+                code = bytearray()
+                send(RAW_BANNER + b">")
+            continue
+        if c == b"\x02":
+            raw = False
+        elif c == b"\x03":
+            code = bytearray()
+        elif c == b"\x05" and not code:
+            # Raw paste: "A\x01" follows.
+            chan.read(2)
+            send(b"R\x01" + bytes((PASTE_WINDOW & 0xFF, PASTE_WINDOW >> 8)))
+            received = 0
+            while True:
+                b = chan.read(1)
+                if b == b"\x04":
+                    break
+                code += b
+                received += 1
+                if received % PASTE_WINDOW == 0:
+                    send(b"\x01")
+            send(b"\x04")
+            run(bytes(code))
+            code = bytearray()
+        elif c == b"\x04":
+            if not code:
+                scope.clear()
+                scope["__name__"] = "__main__"
+                send(b"soft reboot\r\n" + RAW_BANNER + b">")
+            else:
+                send(b"OK")
+                run(bytes(code))
+                code = bytearray()
+        else:
+            code += c
+
+
+if __name__ == "__main__":
+    main()
@@ -18,78 +18,191 @@ _ADV_TYPE_UUID16_MORE = const(0x2)
 _ADV_TYPE_UUID32_MORE = const(0x4)
 _ADV_TYPE_UUID128_MORE = const(0x6)
 _ADV_TYPE_APPEARANCE = const(0x19)
-
-
-# Generate a payload to be passed to gap_advertise(adv_data=...).
-def advertising_payload(limited_disc=False, br_edr=False, name=None, services=None, appearance=0):
-    payload = bytearray()
-
-    def _append(adv_type, value):
-        nonlocal payload
-        payload += struct.pack("BB", len(value) + 1, adv_type) + value
-
-    _append(
-        _ADV_TYPE_FLAGS,
-        struct.pack("B", (0x01 if limited_disc else 0x02) + (0x18 if br_edr else 0x04)),
-    )
-
-    if name:
-        _append(_ADV_TYPE_NAME, name)
-
-    if services:
-        for uuid in services:
-            b = bytes(uuid)
-            if len(b) == 2:
-                _append(_ADV_TYPE_UUID16_COMPLETE, b)
-            elif len(b) == 4:
-                _append(_ADV_TYPE_UUID32_COMPLETE, b)
-            elif len(b) == 16:
-                _append(_ADV_TYPE_UUID128_COMPLETE, b)
-
+_ADV_TYPE_MANUFACTURER = const(0xFF)
+
+# Legacy advertising PDUs carry at most 31 bytes of advertising data, and as
+# much again in the scan response.
+_MAX_PAYLOAD = const(31)
+
+# Fields are laid out here, then copied out once per distinct payload.
+_adv_buf = bytearray(_MAX_PAYLOAD)
+_resp_buf = bytearray(_MAX_PAYLOAD)
+
+# Built payloads by arguments. Devices advertise one or two payloads, so a
+# handful is plenty; the memo starts over when it fills up.
+_MEMO_SIZE = const(4)
+_memo = {}
+
+
+def _append(buf, n, adv_type, value):
+    # Writes one AD structure at offset n, returns the new length or -1 if it
+    # does not fit.
+    end = n + 2 + len(value)
+    if end > _MAX_PAYLOAD:
+        return -1
+    buf[n] = len(value) + 1
+    buf[n + 1] = adv_type
+    buf[n + 2 : end] = value
+    return end
+
+
+# Generate the payloads to be passed to
+# gap_advertise(adv_data=..., resp_data=...). Fields go into the advertising
+# data in order of importance (flags, manufacturer data, services, appearance,
+# name) and whatever does not fit spills into the scan response. Manufacturer
+# data comes first as passive scanners never see the scan response.
+# manufacturer is the raw field value, starting with the company identifier.
+def advertising_payloads(
+    limited_disc=False, br_edr=False, name=None, services=None, appearance=0, manufacturer=None
+):
+    if isinstance(name, str):
+        name = name.encode()
+    uuids = tuple(bytes(uuid) for uuid in services) if services else ()
+    if manufacturer:
+        manufacturer = bytes(manufacturer)
+    key = (limited_disc, br_edr, name, uuids, appearance, manufacturer)
+    payloads = _memo.get(key)
+    if payloads is not None:
+        return payloads
+
+    fields = [
+        (_ADV_TYPE_FLAGS, bytes(((0x01 if limited_disc else 0x02) + (0x18 if br_edr else 0x04),)))
+    ]
+    if manufacturer:
+        fields.append((_ADV_TYPE_MANUFACTURER, manufacturer))
+    # One field per UUID size, listing all the services of that size.
+    for size, adv_type in (
+        (2, _ADV_TYPE_UUID16_COMPLETE),
+        (4, _ADV_TYPE_UUID32_COMPLETE),
+        (16, _ADV_TYPE_UUID128_COMPLETE),
+    ):
+        value = b"".join(uuid for uuid in uuids if len(uuid) == size)
+        if value:
+            fields.append((adv_type, value))
     # See org.bluetooth.characteristic.gap.appearance.xml
     if appearance:
-        _append(_ADV_TYPE_APPEARANCE, struct.pack("<h", appearance))
-
-    print(payload)
-    print(decode_name(payload))
-    print(decode_services(payload))
-    return payload
+        fields.append((_ADV_TYPE_APPEARANCE, struct.pack("<H", appearance)))
+    if name:
+        fields.append((_ADV_TYPE_NAME, name))
+
+    adv_n = resp_n = 0
+    for adv_type, value in fields:
+        n = _append(_adv_buf, adv_n, adv_type, value)
+        if n >= 0:
+            adv_n = n
+            continue
+        n = _append(_resp_buf, resp_n, adv_type, value)
+        if n < 0:
+            raise ValueError("advertising data too long")
+        resp_n = n
+
+    payloads = (bytes(memoryview(_adv_buf)[:adv_n]), bytes(memoryview(_resp_buf)[:resp_n]))
+    if len(_memo) >= _MEMO_SIZE:
+        _memo.clear()
+    _memo[key] = payloads
+    return payloads
+
+
+# Advertising data only, for callers that don't send a scan response. Fields
+# that spilled over are left out.
+def advertising_payload(
+    limited_disc=False, br_edr=False, name=None, services=None, appearance=0, manufacturer=None
+):
+    return advertising_payloads(limited_disc, br_edr, name, services, appearance, manufacturer)[0]
+
+
+def iter_fields(payload):
+    # Yields (adv_type, data) for every AD structure in an advertising or
+    # scan response payload, data being a memoryview into the payload rather
+    # than a copy. Stops at zero length padding and at a structure that runs
+    # past the end, so a malformed packet never reads out of bounds.
+    mv = memoryview(payload)
+    n = len(mv)
+    i = 0
+    while i + 1 < n:
+        end = i + 1 + mv[i]
+        if end == i + 1 or end > n:
+            return
+        yield mv[i + 1], mv[i + 2 : end]
+        i = end
 
 
 def decode_field(payload, adv_type):
+    return [data for t, data in iter_fields(payload) if t == adv_type]
+
+
+def has_uuid128(payload, uuid):
+    # True if the payload lists the 128 bit service `uuid` (its 16 raw bytes).
+    # Walks the AD structures in place, so it is cheap enough for the scan
+    # IRQ and does not allocate.
+    n = len(payload)
+    i = 0
+    while i + 1 < n:
+        end = i + 1 + payload[i]
+        if end == i + 1 or end > n:
+            # Empty or truncated structure, nothing sensible follows.
+            return False
+        adv_type = payload[i + 1]
+        if adv_type == _ADV_TYPE_UUID128_COMPLETE or adv_type == _ADV_TYPE_UUID128_MORE:
+            j = i + 2
+            while j + 16 <= end:
+                k = 0
+                while k < 16 and payload[j + k] == uuid[k]:
+                    k += 1
+                if k == 16:
+                    return True
+                j += 16
+        i = end
+    return False
+
+
+def find_field(payload, adv_type):
+    # Offset of the data of the first adv_type structure, or -1; its length
+    # is payload[offset - 2] - 1. Allocation free, like has_uuid128.
+    n = len(payload)
     i = 0
-    result = []
-    while i + 1 < len(payload):
+    while i + 1 < n:
+        end = i + 1 + payload[i]
+        if end == i + 1 or end > n:
+            return -1
         if payload[i + 1] == adv_type:
-            result.append(payload[i + 2 : i + payload[i] + 1])
-        i += 1 + payload[i]
-    return result
+            return i + 2
+        i = end
+    return -1
 
 
 def decode_name(payload):
-    n = decode_field(payload, _ADV_TYPE_NAME)
-    return str(n[0], "utf-8") if n else ""
+    for adv_type, data in iter_fields(payload):
+        if adv_type == _ADV_TYPE_NAME:
+            return str(data, "utf-8")
+    return ""
 
 
 def decode_services(payload):
+    # A field may list several UUIDs; "more available" lists count too.
     services = []
-    for u in decode_field(payload, _ADV_TYPE_UUID16_COMPLETE):
-        services.append(bluetooth.UUID(struct.unpack("<h", u)[0]))
-    for u in decode_field(payload, _ADV_TYPE_UUID32_COMPLETE):
-        services.append(bluetooth.UUID(struct.unpack("<d", u)[0]))
-    for u in decode_field(payload, _ADV_TYPE_UUID128_COMPLETE):
-        services.append(bluetooth.UUID(u))
+    for adv_type, data in iter_fields(payload):
+        if adv_type == _ADV_TYPE_UUID16_COMPLETE or adv_type == _ADV_TYPE_UUID16_MORE:
+            for i in range(0, len(data) - 1, 2):
+                services.append(bluetooth.UUID(struct.unpack_from("<H", data, i)[0]))
+        elif adv_type == _ADV_TYPE_UUID32_COMPLETE or adv_type == _ADV_TYPE_UUID32_MORE:
+            # bluetooth.UUID only takes 16 bit values as ints.
+            for i in range(0, len(data) - 3, 4):
+                services.append(bluetooth.UUID(bytes(data[i : i + 4])))
+        elif adv_type == _ADV_TYPE_UUID128_COMPLETE or adv_type == _ADV_TYPE_UUID128_MORE:
+            for i in range(0, len(data) - 15, 16):
+                services.append(bluetooth.UUID(bytes(data[i : i + 16])))
     return services
 
 
 def demo():
-    payload = advertising_payload(
+    adv_data, resp_data = advertising_payloads(
         name="micropython",
         services=[bluetooth.UUID(0x181A), bluetooth.UUID("6E400001-B5A3-F393-E0A9-E50E24DCCA9E")],
     )
-    print(payload)
-    print(decode_name(payload))
-    print(decode_services(payload))
+    print(adv_data, resp_data)
+    print(decode_name(adv_data) or decode_name(resp_data))
+    print(decode_services(adv_data))
 
 
 if __name__ == "__main__":
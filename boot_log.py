@@ -0,0 +1,24 @@
+# Boot timeline: ms since reset for each startup phase, to measure how long
+# a node takes to light up and get on air after a brownout.
+
+import utime
+
+_phases = []
+
+
+def mark(phase):
+    # ticks_ms starts counting at reset, so this is time since boot.
+    t = utime.ticks_ms()
+    _phases.append((t, phase))
+    print('[boot] {:6d} ms  {}'.format(t, phase))
+
+
+def mark_once(phase):
+    for _, seen in _phases:
+        if seen == phase:
+            return
+    mark(phase)
+
+
+def timeline():
+    return _phases
@@ -2,10 +2,16 @@
 
 import machine
 import network
+import os
 import time
-import json
+import struct
+import binascii
 import sys
 import uasyncio
+import utime
+from array import array
+
+import boot_log
 
 # Global Variables
 
@@ -18,12 +24,60 @@ last_update_pulses = 0
 last_update_litres = 0
 sensor = {}
 
+# Pour events passed to the flow handler.
+POUR_END = 0
+POUR_START = 1
+POUR_FLOW = 2
+
+# Minimum time between two POUR_FLOW events.
+MIN_NOTIFY_MS = 250
+# A pour is over once no pulse came in for this long.
+IDLE_MS = 2000
+
+# Sensor calibration: pulses per litre (YF-S201 datasheet value).
+K_FACTOR = 450
+# Flow rate is measured over the pulses of this last stretch of time.
+WINDOW_MS = 1000
+# Weight of a new rate sample in the smoothed rate, in 1/256.
+SMOOTHING = 64
+
+# Count pulses with the ESP32 hardware pulse counter (machine.Counter)
+# instead of a pin IRQ. The counter never misses an edge while BLE or the
+# LED task hold the CPU, but it is polled, every POLL_MS.
+USE_HW_COUNTER = False
+POLL_MS = 50
+
+# Total pulse count, the only state the pulse IRQ writes besides the ring.
+_counts = array('L', [0])
+
+# Timestamps (ticks_ms) of the last _RING_SIZE pulses. Pulse n lands in
+# slot n & _RING_MASK.
+_RING_SIZE = 32
+_RING_MASK = _RING_SIZE - 1
+_ring = array('L', [0] * _RING_SIZE)
+
+# Set from the pulse IRQ, wakes the pour detector when a pour starts.
+_pulse_flag = uasyncio.ThreadSafeFlag()
+
+# Pulse totals are journaled to JOURNAL_PATH.0 / JOURNAL_PATH.1, at most once
+# every SAVE_MS, with JOURNAL_RECORDS records per segment before compaction.
+JOURNAL_PATH = 'flow.jnl'
+JOURNAL_RECORDS = 128
+SAVE_MS = 30000
+
+# Journal record: magic, sequence number, total pulses, pulses on this keg,
+# CRC32 of the preceding bytes.
+_RECORD_FORMAT = '<IIIII'
+_RECORD_MAGIC = 0x4A46
+_RECORD_SIZE = 20
+_RECORD_CRC = 16
+
 '''
 Setup pins (GPIO)
 '''
 
 
-def setupPins():
+def setupPins(hw_counter=USE_HW_COUNTER):
     global sensor, led
 
     s = machine.Pin(SENSOR_PIN, machine.Pin.IN)
@@ -32,10 +86,18 @@ def setupPins():
     sensor['pulses'] = 0
     sensor['litres'] = 0
 
-    s.irq(trigger=machine.Pin.IRQ_FALLING, handler=water_tick_handler)
+    source = None
+    if hw_counter:
+        try:
+            source = HardwarePulseCounter(s)
+        except (AttributeError, ValueError, OSError) as e:
+            print('no hardware counter, using pin irq', e)
+    if source is None:
+        source = IrqPulseCounter(s)
 
     led = machine.Pin(STATUS_LED, machine.Pin.OUT)
     print('pins setup')
+    return source
 
 
 # ------------------------------------------------------------------
@@ -53,50 +115,352 @@ def toggleLed():
 
 # ------------------------------------------------------------------
 
-def water_tick_handler(p):
-    global sensor
-    id = str(p)[4:-1]
-    sensor['pulses'] += 1
-
-    toggleLed()
-
-
-
-def save():
-    global sensor
-    print("[+] Saving State")
-
-    f = open('state.json', 'w')
-    json.dump(sensors, f)
-    f.close()
+# Runs for every falling edge, hundreds of times per second at full flow, so
+# it only touches preallocated arrays. Everything it needs is bound as a
+# default argument to skip the global lookups.
+def water_tick_handler(
+    p, counts=_counts, ring=_ring, ticks_ms=utime.ticks_ms, wake=_pulse_flag.set
+):
+    n = counts[0]
+    ring[n & _RING_MASK] = ticks_ms()
+    counts[0] = n + 1
+    wake()
+
+
+class IrqPulseCounter:
+    polled = False
+
+    def __init__(self, pin):
+        pin.irq(trigger=machine.Pin.IRQ_FALLING, handler=water_tick_handler, hard=True)
+
+    def poll(self):
+        pass
+
+
+class HardwarePulseCounter:
+    # Counts edges in the ESP32 PCNT peripheral. poll() moves new counts into
+    # _counts and spreads their timestamps evenly over the time since the
+    # previous poll, so FlowMeter works the same as with the IRQ.
+    polled = True
+
+    def __init__(self, pin, unit=0):
+        self._counter = machine.Counter(unit, pin, edge=machine.Counter.FALLING)
+        self._counter.value(0)
+        self._last = 0
+        self._last_tick = utime.ticks_ms()
+
+    def poll(self):
+        value = self._counter.value()
+        now = utime.ticks_ms()
+        new = value - self._last
+        if new > 0:
+            span = utime.ticks_diff(now, self._last_tick)
+            n = _counts[0]
+            for k in range(max(0, new - _RING_SIZE), new):
+                _ring[(n + k) & _RING_MASK] = utime.ticks_add(
+                    self._last_tick, span * (k + 1) // new
+                )
+            _counts[0] = n + new
+            self._last = value
+            _pulse_flag.set()
+        self._last_tick = now
+
+
+class Journal:
+    # Crash-safe store for the pulse totals: an append-only file of fixed
+    # size, CRC-checked records, split over two segment files.
+    #
+    # Each save appends one record to the current segment. When it is full,
+    # the latest state is written as the first record of the other segment
+    # before the old one is removed, so a reset at any point leaves at least
+    # one valid record behind. A torn final write just fails its CRC and the
+    # record before it wins.
+    def __init__(
+        self, path=JOURNAL_PATH, records_per_segment=JOURNAL_RECORDS, min_interval_ms=SAVE_MS
+    ):
+        self._paths = (path + '.0', path + '.1')
+        self.records_per_segment = records_per_segment
+        self.min_interval_ms = min_interval_ms
+        self._record = bytearray(_RECORD_SIZE)
+        self._segment = 0
+        self._records = 0
+        self._seq = 0
+        self._saved = None
+        self._last_save = None
+
+    def _pack(self, seq, total, keg):
+        struct.pack_into(_RECORD_FORMAT, self._record, 0, _RECORD_MAGIC, seq, total, keg, 0)
+        crc = binascii.crc32(memoryview(self._record)[:_RECORD_CRC]) & 0xFFFFFFFF
+        struct.pack_into('<I', self._record, _RECORD_CRC, crc)
+        return self._record
+
+    def _valid(self, record):
+        if record[0] | record[1] << 8 != _RECORD_MAGIC:
+            return False
+        crc = binascii.crc32(memoryview(record)[:_RECORD_CRC]) & 0xFFFFFFFF
+        return crc == struct.unpack_from('<I', record, _RECORD_CRC)[0]
+
+    def _first_seq(self, segment):
+        try:
+            with open(self._paths[segment], 'rb') as f:
+                if f.readinto(self._record) == _RECORD_SIZE and self._valid(self._record):
+                    return struct.unpack_from('<I', self._record, 4)[0]
+        except OSError:
+            pass
+        return -1
+
+    def _scan(self, segment):
+        # Returns (records, last valid (seq, total, keg), clean) of a segment;
+        # clean is False if anything follows the last valid record.
+        last = None
+        records = 0
+        with open(self._paths[segment], 'rb') as f:
+            while True:
+                n = f.readinto(self._record)
+                if n != _RECORD_SIZE or not self._valid(self._record):
+                    break
+                records += 1
+                last = struct.unpack_from('<III', self._record, 4)
+        return records, last, not n
+
+    def restore(self, meter):
+        # Only the segment holding the newest records is scanned.
+        first = (self._first_seq(0), self._first_seq(1))
+        segment = 0 if first[0] >= first[1] else 1
+        if first[segment] < 0:
+            # Whatever is there (a first save torn by a reset) would sit in
+            # front of every record appended after it.
+            for path in self._paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            print('no saved flow state')
+            return False
+        self._segment = segment
+        self._records, (self._seq, total, keg), clean = self._scan(segment)
+        if not clean:
+            # Records appended after a torn one would all be misaligned, so
+            # carry on in the other segment.
+            self._seq += 1
+            self._compact(self._pack(self._seq, total, keg))
+        _counts[0] = total
+        meter.keg_start = total - keg
+        meter.update_totals()
+        self._saved = (total, keg)
+        print('restored', total, 'pulses,', keg, 'on this keg')
+        return True
+
+    def save(self, meter, force=False):
+        # Writes the meter's totals unless nothing changed, or unless the
+        # last write was less than min_interval_ms ago and force is unset.
+        # Returns True if a record was written.
+        total = meter.pulses()
+        keg = total - meter.keg_start
+        if (total, keg) == self._saved:
+            return False
+        now = utime.ticks_ms()
+        if (
+            not force
+            and self._last_save is not None
+            and utime.ticks_diff(now, self._last_save) < self.min_interval_ms
+        ):
+            return False
+        self._seq += 1
+        record = self._pack(self._seq, total, keg)
+        if self._records >= self.records_per_segment:
+            self._compact(record)
+        else:
+            with open(self._paths[self._segment], 'ab') as f:
+                f.write(record)
+            self._records += 1
+        self._saved = (total, keg)
+        self._last_save = now
+        return True
+
+    def _compact(self, record):
+        old = self._segment
+        self._segment ^= 1
+        with open(self._paths[self._segment], 'wb') as f:
+            f.write(record)
+        self._records = 1
+        try:
+            os.remove(self._paths[old])
+        except OSError:
+            pass
+
+    async def autosave(self, meter):
+        # Picks up totals that a rate-limited save() skipped.
+        while True:
+            await uasyncio.sleep_ms(self.min_interval_ms)
+            self.save(meter)
 
 
 # ------------------------------------------------------------------
 
-def restore():
-    global sensors
-    try:
-        f = open('state.json', 'r')
-        print("[+] Restoring State")
-        sensors = json.load(f)
-        f.close()
-    except OSError:
-        return False
-
-
-# ------------------------------------------------------------------
-
-async def flow(handle_data):
-    setupPins()
-
-    while True:
-        # toggleLed()
-        await uasyncio.sleep(1)
-        # if time.time() % 5 == 0:
-        handle_data(sensor['pulses'])
-
-def print_pulses(pulses):
-    print(f'pulses {pulses}')
+class FlowMeter:
+    # Turns the raw pulse count into flow rate and volumes using the
+    # calibrated K-factor (pulses per litre).
+    def __init__(self, k_factor=K_FACTOR, window_ms=WINDOW_MS, smoothing=SMOOTHING):
+        self.k_factor = k_factor
+        self.window_ms = window_ms
+        self.smoothing = smoothing
+        # Pulse counts at the start of the keg and of the current pour.
+        self.keg_start = 0
+        self.pour_start = 0
+        self.rate = 0
+        self.smoothed_rate = 0
+
+    def pulses(self):
+        return _counts[0]
+
+    def volume_ml(self, pulses):
+        return pulses * 1000 // self.k_factor
+
+    def pour_ml(self):
+        return self.volume_ml(self.pulses() - self.pour_start)
+
+    def keg_ml(self):
+        return self.volume_ml(self.pulses() - self.keg_start)
+
+    def start_pour(self, pulses=None):
+        self.pour_start = self.pulses() if pulses is None else pulses
+        self.rate = self.smoothed_rate = 0
+
+    def end_pour(self):
+        self.rate = self.smoothed_rate = 0
+        self.update_totals()
+
+    def reset_keg(self):
+        self.keg_start = self.pulses()
+
+    def update_totals(self):
+        sensor['pulses'] = self.pulses()
+        litres = self.pulses() / self.k_factor
+        sensor['litres'] = litres
+        sensor['m3'] = litres / 1000
+
+    def instant_rate(self, now=None):
+        # ml/min from the pulses in the last window_ms that are still in the
+        # ring, 0 if there are fewer than two.
+        if now is None:
+            now = utime.ticks_ms()
+        newest = self.pulses() - 1
+        if newest < 1 or utime.ticks_diff(now, _ring[newest & _RING_MASK]) > self.window_ms:
+            return 0
+        oldest = newest
+        while oldest > 0 and newest - oldest < _RING_MASK:
+            if utime.ticks_diff(now, _ring[(oldest - 1) & _RING_MASK]) > self.window_ms:
+                break
+            oldest -= 1
+        span = utime.ticks_diff(_ring[newest & _RING_MASK], _ring[oldest & _RING_MASK])
+        if newest == oldest or span <= 0:
+            return 0
+        # Tenths of a pulse per minute first, so the ml conversion stays in
+        # small ints.
+        return (newest - oldest) * 600000 // span * 100 // self.k_factor
+
+    def update_rate(self, now=None):
+        self.rate = self.instant_rate(now)
+        self.smoothed_rate += (self.rate - self.smoothed_rate) * self.smoothing // 256
+        return self.smoothed_rate
+
+
+class PourDetector:
+    # Sleeps on the pulse flag while the tap is closed, reports the start of a
+    # pour straight away, rate changes at most every min_interval_ms and a
+    # single POUR_END once no pulses came in for idle_ms.
+    def __init__(
+        self,
+        handle_data,
+        meter=None,
+        source=None,
+        min_interval_ms=MIN_NOTIFY_MS,
+        idle_ms=IDLE_MS,
+        journal=None,
+    ):
+        self._handle_data = handle_data
+        self.meter = meter or FlowMeter()
+        self.source = source
+        self.journal = journal
+        self.min_interval_ms = min_interval_ms
+        self.idle_ms = idle_ms
+        self.pouring = False
+        self.rate = 0
+
+    async def run(self):
+        meter = self.meter
+        while True:
+            idle = meter.pulses()
+            _pulse_flag.clear()
+            await self._wait_for_pulse(idle)
+            self.pouring = True
+            self.rate = 0
+            # Pulses that came in before we got to run are part of the pour.
+            meter.start_pour(idle)
+            self._handle_data(POUR_START, meter)
+            await self._follow_pour()
+            self.pouring = False
+            self.rate = 0
+            meter.end_pour()
+            self._handle_data(POUR_END, meter)
+            if self.journal is not None:
+                self.journal.save(meter)
+
+    async def _wait_for_pulse(self, idle):
+        if self.source is not None and self.source.polled:
+            while self.meter.pulses() == idle:
+                await uasyncio.sleep_ms(POLL_MS)
+                self.source.poll()
+        elif self.meter.pulses() == idle:
+            await _pulse_flag.wait()
+
+    async def _follow_pour(self):
+        meter = self.meter
+        pulses = meter.pulses()
+        last_pulse = utime.ticks_ms()
+        while True:
+            await uasyncio.sleep_ms(self.min_interval_ms)
+            if self.source is not None:
+                self.source.poll()
+            now = utime.ticks_ms()
+            new_pulses = meter.pulses()
+            if new_pulses != pulses:
+                pulses = new_pulses
+                last_pulse = now
+                toggleLed()
+            elif utime.ticks_diff(now, last_pulse) >= self.idle_ms:
+                return
+            rate = meter.update_rate(now)
+            if rate != self.rate:
+                self.rate = rate
+                self._handle_data(POUR_FLOW, meter)
+
+
+async def flow(
+    handle_data,
+    meter=None,
+    min_interval_ms=MIN_NOTIFY_MS,
+    idle_ms=IDLE_MS,
+    hw_counter=USE_HW_COUNTER,
+    journal=None,
+    restore=True,
+):
+    # restore=False if the caller already restored the journal into meter.
+    meter = meter or FlowMeter()
+    if journal is not None:
+        # Restore before the pulse IRQ starts counting on top of the total.
+        if restore:
+            journal.restore(meter)
+        uasyncio.create_task(journal.autosave(meter))
+    source = setupPins(hw_counter)
+    meter.update_totals()
+    boot_log.mark('counting pulses')
+    detector = PourDetector(handle_data, meter, source, min_interval_ms, idle_ms, journal)
+    await detector.run()
+
+def print_pulses(event, meter):
+    print(f'event {event} rate {meter.smoothed_rate} ml/min pour {meter.pour_ml()} ml')
 
 
 # Main Program
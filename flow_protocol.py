@@ -0,0 +1,73 @@
+# Value format of the flow characteristic.
+#
+# Shared by the flow node (packing) and the light nodes and host tools
+# (unpacking). All quantities are fixed point integers:
+#   state (B)    0 idle, 1 pouring
+#   rate (<H)    flow rate in ml/min
+#   pour (<I)    volume of the current (or last) pour in ml
+#   keg (<I)     volume drawn from the current keg in ml
+#
+# The same values are broadcast as manufacturer specific advertising data,
+# so light nodes can follow a tap without connecting:
+#   company (<H) COMPANY_ID
+#   frame (B)    ADV_FRAME, tells our frames from other users of the ID
+#   seq (B)      bumped on every update, wraps at 255
+#   state (B), rate (<H), pour (<I), keg (<I) as above
+
+import struct
+
+FORMAT = "<BHII"
+SIZE = struct.calcsize(FORMAT)
+
+STATE_IDLE = 0
+STATE_POURING = 1
+
+_RATE_MAX = 0xFFFF
+
+# 0xFFFF is the Bluetooth SIG's company identifier for internal and test use.
+COMPANY_ID = 0xFFFF
+ADV_FRAME = 0xF1
+ADV_FORMAT = "<HBBBHII"
+ADV_SIZE = struct.calcsize(ADV_FORMAT)
+
+
+def pack(state, rate, pour_ml, keg_ml):
+    return struct.pack(FORMAT, state, min(rate, _RATE_MAX), pour_ml, keg_ml)
+
+
+def pack_into(buf, state, rate, pour_ml, keg_ml):
+    struct.pack_into(FORMAT, buf, 0, state, min(rate, _RATE_MAX), pour_ml, keg_ml)
+
+
+def unpack(data):
+    # Returns (state, rate, pour_ml, keg_ml). The original firmware only sent
+    # a little endian int16 state, which is still accepted.
+    if len(data) == 2:
+        return (1 if struct.unpack("<h", data)[0] else 0, 0, 0, 0)
+    return struct.unpack(FORMAT, data)
+
+
+def adv_pack(seq, state, rate, pour_ml, keg_ml):
+    return struct.pack(
+        ADV_FORMAT, COMPANY_ID, ADV_FRAME, seq & 0xFF, state, min(rate, _RATE_MAX), pour_ml, keg_ml
+    )
+
+
+def adv_match(data, offset, length):
+    # True if the manufacturer data at offset is one of our frames. Reads the
+    # bytes in place so scanners can call it for every advertisement.
+    return (
+        length == ADV_SIZE
+        and data[offset] == COMPANY_ID & 0xFF
+        and data[offset + 1] == COMPANY_ID >> 8
+        and data[offset + 2] == ADV_FRAME
+    )
+
+
+def adv_seq(data, offset):
+    return data[offset + 3]
+
+
+def adv_unpack_from(data, offset=0):
+    # Returns (seq, state, rate, pour_ml, keg_ml) of a frame adv_match accepted.
+    return struct.unpack_from(ADV_FORMAT, data, offset)[2:]
@@ -0,0 +1,300 @@
+# Gateway: a Linux box that follows every flow node and drives every light
+# node over BLE, instead of one ESP32 light node per tap.
+#
+#   python gateway.py [--route LIGHT=FLOW[,FLOW...]] ...
+#   python gateway.py --simulate TAPS LIGHTS [--duration SECONDS]
+#
+# It scans for ever. Every `beerflow` and `lightpi` node found gets its own
+# task that connects, subscribes (flow nodes) and reconnects with backoff
+# when the link drops. Pour state from the flow nodes, by notification or by
+# their broadcast advertising data, is fanned out to the light nodes as
+# effect commands. By default a light node shows the rainbow while any tap
+# pours; --route limits it to some taps.
+#
+# The radio sits behind a small backend interface, BleakBackend here and
+# gateway_sim.SimBackend for running without one.
+
+import argparse
+import asyncio
+import logging
+import random
+import struct
+import sys
+
+import flow_protocol
+import led_protocol
+
+FLOW_NAME = "beerflow"
+LIGHT_NAME = "lightpi"
+FLOW_CHAR = "f05e45d2-3352-4839-8f7a-cf950ae1f09e"
+LIGHT_CHAR = "3c110d21-b7a4-4115-889a-77a03fdbcda3"
+
+CONNECT_TIMEOUT_S = 10
+RECONNECT_MIN_S = 0.5
+RECONNECT_MAX_S = 30
+# BlueZ and most adapters handle only a few connection attempts at once;
+# the rest queue up here.
+MAX_CONNECTING = 3
+STATS_S = 30
+
+log = logging.getLogger("gateway")
+
+
+class BleakBackend:
+    # The real radio. bleak is only imported here, so the simulated backend
+    # runs without it.
+    def __init__(self):
+        self._scanner = None
+
+    async def start_scan(self, callback):
+        from bleak import BleakScanner
+
+        def detected(device, adv):
+            callback(device.address, adv.local_name or device.name, adv.manufacturer_data)
+
+        self._scanner = BleakScanner(detection_callback=detected)
+        await self._scanner.start()
+
+    async def stop_scan(self):
+        if self._scanner is not None:
+            await self._scanner.stop()
+
+    async def connect(self, address, on_disconnect):
+        from bleak import BleakClient
+
+        client = BleakClient(address, disconnected_callback=lambda _client: on_disconnect())
+        await client.connect()
+        return _BleakLink(client)
+
+
+class _BleakLink:
+    def __init__(self, client):
+        self._client = client
+
+    async def start_notify(self, uuid, callback):
+        await self._client.start_notify(uuid, lambda _sender, data: callback(bytes(data)))
+
+    async def read(self, uuid):
+        return bytes(await self._client.read_gatt_char(uuid))
+
+    async def write(self, uuid, data, response=True):
+        await self._client.write_gatt_char(uuid, data, response=response)
+
+    async def disconnect(self):
+        await self._client.disconnect()
+
+
+class Node:
+    # A flow or light node the gateway has seen, and its link if any.
+    def __init__(self, address, name, kind):
+        self.address = address
+        self.name = name
+        self.kind = kind
+        self.link = None
+        self.task = None
+        self.connects = 0
+        self.failures = 0
+        # Flow nodes: (state, rate, pour_ml, keg_ml) and the last broadcast
+        # sequence number.
+        self.value = (flow_protocol.STATE_IDLE, 0, 0, 0)
+        self.seq = -1
+        # Light nodes: the effect it is showing, as far as we know.
+        self.effect = None
+        self.writing = False
+
+    def __repr__(self):
+        return "{} {}".format(self.name, self.address)
+
+
+class Gateway:
+    def __init__(self, backend, routes=None, max_connecting=MAX_CONNECTING):
+        self._backend = backend
+        # Light address -> flow addresses it follows; lights not listed
+        # follow every tap.
+        self._routes = routes or {}
+        self._max_connecting = max_connecting
+        self._connecting = None
+        self.nodes = {}
+
+    def flows(self):
+        return [n for n in self.nodes.values() if n.kind == "flow"]
+
+    def lights(self):
+        return [n for n in self.nodes.values() if n.kind == "light"]
+
+    def _on_device(self, address, name, manufacturer_data):
+        frame = manufacturer_data.get(flow_protocol.COMPANY_ID) if manufacturer_data else None
+        node = self.nodes.get(address)
+        if node is None:
+            if name == LIGHT_NAME:
+                kind = "light"
+            elif name == FLOW_NAME or frame is not None:
+                kind = "flow"
+            else:
+                return
+            node = Node(address, name or "?", kind)
+            self.nodes[address] = node
+            log.info("found %s", node)
+            node.task = asyncio.get_running_loop().create_task(self._maintain(node))
+        if frame is not None and node.kind == "flow":
+            self._on_broadcast(node, frame)
+
+    def _on_broadcast(self, node, frame):
+        # bleak strips the company identifier from manufacturer data.
+        data = struct.pack("<H", flow_protocol.COMPANY_ID) + bytes(frame)
+        if not flow_protocol.adv_match(data, 0, len(data)):
+            return
+        seq, *value = flow_protocol.adv_unpack_from(data)
+        if seq != node.seq:
+            node.seq = seq
+            self._on_flow(node, tuple(value))
+
+    async def _maintain(self, node):
+        # Connects and keeps reconnecting one node, for ever.
+        backoff = RECONNECT_MIN_S
+        while True:
+            lost = asyncio.Event()
+            try:
+                async with self._connecting:
+                    node.link = await asyncio.wait_for(
+                        self._backend.connect(node.address, lost.set), CONNECT_TIMEOUT_S
+                    )
+                    if node.kind == "flow":
+                        await node.link.start_notify(
+                            FLOW_CHAR, lambda data: self._on_flow(node, flow_protocol.unpack(data))
+                        )
+                        # A pour may have started or ended while we were away.
+                        self._on_flow(node, flow_protocol.unpack(await node.link.read(FLOW_CHAR)))
+            except Exception as e:
+                # BleakError, timeouts and D-Bus errors alike: try again later.
+                # A link that connected but failed to set up is closed, or the
+                # next attempt would open a second one to the same node.
+                if node.link is not None:
+                    try:
+                        await node.link.disconnect()
+                    except Exception:
+                        pass
+                node.link = None
+                node.failures += 1
+                delay = backoff * (1 + random.random() / 2)
+                backoff = min(backoff * 2, RECONNECT_MAX_S)
+                log.info("%s: connect failed (%r), retry in %.1fs", node, e, delay)
+                await asyncio.sleep(delay)
+                continue
+
+            backoff = RECONNECT_MIN_S
+            node.connects += 1
+            log.info("connected %s", node)
+            if node.kind == "light":
+                # Whatever it showed before, bring it up to date.
+                node.effect = None
+                self._fan_out()
+            await lost.wait()
+            node.link = None
+            log.info("lost %s", node)
+
+    def _on_flow(self, node, value):
+        if value[0] != node.value[0]:
+            log.info(
+                "%s: %s, %d ml",
+                node,
+                "pouring" if value[0] == flow_protocol.STATE_POURING else "idle",
+                value[2],
+            )
+        node.value = value
+        self._fan_out()
+
+    def _wanted(self, light):
+        follows = self._routes.get(light.address)
+        for flow in self.flows():
+            if (follows is None or flow.address in follows) and flow.value[0]:
+                return led_protocol.EFFECT_RAINBOW
+        return led_protocol.EFFECT_OFF
+
+    def _fan_out(self):
+        loop = asyncio.get_running_loop()
+        for light in self.lights():
+            if light.link is not None and not light.writing and self._wanted(light) != light.effect:
+                light.writing = True
+                loop.create_task(self._write(light))
+
+    async def _write(self, light):
+        # One write in flight per light; states that change meanwhile are
+        # caught up with before returning.
+        try:
+            while light.link is not None:
+                effect = self._wanted(light)
+                if effect == light.effect:
+                    break
+                command = led_protocol.pack(led_protocol.set_effect(effect))
+                await light.link.write(LIGHT_CHAR, command, True)
+                light.effect = effect
+        except Exception as e:
+            log.info("%s: write failed (%r)", light, e)
+        finally:
+            light.writing = False
+
+    def stats(self):
+        return {
+            "flows": len(self.flows()),
+            "lights": len(self.lights()),
+            "connected": sum(1 for n in self.nodes.values() if n.link is not None),
+            "pouring": sum(1 for n in self.flows() if n.value[0]),
+            "connects": sum(n.connects for n in self.nodes.values()),
+            "failures": sum(n.failures for n in self.nodes.values()),
+        }
+
+    async def run(self):
+        self._connecting = asyncio.Semaphore(self._max_connecting)
+        await self._backend.start_scan(self._on_device)
+        try:
+            while True:
+                await asyncio.sleep(STATS_S)
+                log.info("stats %s", self.stats())
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        await self._backend.stop_scan()
+        for node in self.nodes.values():
+            if node.task is not None:
+                node.task.cancel()
+            if node.link is not None:
+                try:
+                    await node.link.disconnect()
+                except Exception:
+                    pass
+                node.link = None
+
+
+def parse_routes(routes):
+    result = {}
+    for route in routes or ():
+        light, _, flows = route.partition("=")
+        result[light] = set(flows.split(","))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--route", action="append", help="LIGHT=FLOW[,FLOW...] addresses")
+    parser.add_argument("--simulate", nargs=2, type=int, metavar=("TAPS", "LIGHTS"))
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose or args.simulate else logging.WARNING,
+        format="%(asctime)s %(message)s",
+    )
+
+    if args.simulate:
+        import gateway_sim
+
+        ok = asyncio.run(gateway_sim.scenario(*args.simulate, duration=args.duration))
+        sys.exit(0 if ok else 1)
+    else:
+        asyncio.run(Gateway(BleakBackend(), parse_routes(args.route)).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# Simulated BLE backend for gateway.py: flow and light nodes that live in
+# memory, with connection latency, failed connects and dropped links, so the
+# gateway can be run and checked without a radio.
+#
+#   python gateway.py --simulate TAPS LIGHTS [--duration SECONDS]
+
+import asyncio
+import logging
+import random
+
+import flow_protocol
+import led_protocol
+from gateway import FLOW_CHAR, FLOW_NAME, LIGHT_CHAR, LIGHT_NAME, Gateway
+
+log = logging.getLogger("gateway.sim")
+
+SETTLE_S = 5
+
+
+class SimFlowNode:
+    def __init__(self, address, name=FLOW_NAME):
+        self.address = address
+        self.name = name
+        self.value = (flow_protocol.STATE_IDLE, 0, 0, 0)
+        self.keg_ml = 0
+        self._subscribers = []
+
+    def set_flow(self, state, rate, pour_ml):
+        self.value = (state, rate, pour_ml, int(self.keg_ml))
+        data = flow_protocol.pack(*self.value)
+        for callback in list(self._subscribers):
+            callback(data)
+
+    async def pour(self, rate, seconds, step=0.25):
+        # Start, rate updates every step, end; like flow.PourDetector.
+        pour_ml = 0
+        self.set_flow(flow_protocol.STATE_POURING, rate, 0)
+        for _ in range(int(seconds / step)):
+            await asyncio.sleep(step)
+            ml = rate * step / 60
+            pour_ml += ml
+            self.keg_ml += ml
+            self.set_flow(flow_protocol.STATE_POURING, rate, int(pour_ml))
+        self.set_flow(flow_protocol.STATE_IDLE, 0, int(pour_ml))
+
+
+class SimLightNode:
+    def __init__(self, address, name=LIGHT_NAME):
+        self.address = address
+        self.name = name
+        self.effect = led_protocol.EFFECT_OFF
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        for opcode, effect, *_ in led_protocol.unpack(data):
+            if opcode == led_protocol.OP_EFFECT:
+                self.effect = effect
+
+
+class SimBackend:
+    def __init__(self, nodes, connect_s=0.05, fail_rate=0.1, setup_fail_rate=0.1, seed=None):
+        self.nodes = {node.address: node for node in nodes}
+        self.connect_s = connect_s
+        self.fail_rate = fail_rate
+        # Links that connect but then fail their first read.
+        self.setup_fail_rate = setup_fail_rate
+        self.double_links = 0
+        self._random = random.Random(seed)
+        self._links = {}
+        self._scan_task = None
+
+    async def start_scan(self, callback):
+        self._scan_task = asyncio.get_running_loop().create_task(self._advertise(callback))
+
+    async def _advertise(self, callback):
+        while True:
+            for node in self.nodes.values():
+                callback(node.address, node.name, {})
+            await asyncio.sleep(0.2)
+
+    async def stop_scan(self):
+        if self._scan_task is not None:
+            self._scan_task.cancel()
+
+    async def connect(self, address, on_disconnect):
+        await asyncio.sleep(self.connect_s * (0.5 + self._random.random()))
+        if self._random.random() < self.fail_rate:
+            raise ConnectionError("simulated connect failure")
+        old = self._links.get(address)
+        if old is not None and old.connected:
+            # The gateway lost track of a link that is still up.
+            self.double_links += 1
+        link = SimLink(self.nodes[address], on_disconnect)
+        link.fail_read = self._random.random() < self.setup_fail_rate
+        self._links[address] = link
+        return link
+
+    def drop(self, address):
+        # The node goes out of range or reboots.
+        link = self._links.pop(address, None)
+        if link is not None:
+            link.drop()
+
+
+class SimLink:
+    def __init__(self, node, on_disconnect):
+        self._node = node
+        self._on_disconnect = on_disconnect
+        self._callbacks = []
+        self.connected = True
+        self.fail_read = False
+
+    async def start_notify(self, uuid, callback):
+        assert uuid == FLOW_CHAR
+        self._callbacks.append(callback)
+        self._node._subscribers.append(callback)
+
+    async def read(self, uuid):
+        assert uuid == FLOW_CHAR
+        await asyncio.sleep(0.01)
+        if self.fail_read:
+            raise ConnectionError("simulated read failure")
+        return flow_protocol.pack(*self._node.value)
+
+    async def write(self, uuid, data, response=True):
+        assert uuid == LIGHT_CHAR
+        if not self.connected:
+            raise ConnectionError("not connected")
+        await asyncio.sleep(0.01)
+        self._node.write(data)
+
+    async def disconnect(self):
+        self.drop()
+
+    def drop(self):
+        if not self.connected:
+            return
+        self.connected = False
+        for callback in self._callbacks:
+            self._node._subscribers.remove(callback)
+        self._on_disconnect()
+
+
+async def scenario(taps, lights, duration=30, seed=1):
+    # Random pours on every tap and random link drops; at the end every
+    # light must show what the taps are doing.
+    rnd = random.Random(seed)
+    flows = [SimFlowNode("F0:00:00:00:00:%02X" % i) for i in range(taps)]
+    leds = [SimLightNode("L0:00:00:00:00:%02X" % i) for i in range(lights)]
+    backend = SimBackend(flows + leds, seed=seed)
+    gateway = Gateway(backend)
+    task = asyncio.get_running_loop().create_task(gateway.run())
+
+    loop = asyncio.get_running_loop()
+    end = loop.time() + duration
+    pours = []
+    while loop.time() < end:
+        await asyncio.sleep(0.5)
+        flow = rnd.choice(flows)
+        if flow.value[0] == flow_protocol.STATE_IDLE and rnd.random() < 0.3:
+            pours.append(loop.create_task(flow.pour(rnd.randint(1000, 3000), rnd.uniform(1, 4))))
+        if rnd.random() < 0.1:
+            backend.drop(rnd.choice(flows + leds).address)
+    await asyncio.gather(*pours)
+    # Long enough for dropped links to come back and catch up.
+    await asyncio.sleep(SETTLE_S)
+
+    pouring = any(flow.value[0] for flow in flows)
+    want = led_protocol.EFFECT_RAINBOW if pouring else led_protocol.EFFECT_OFF
+    ok = all(light.effect == want for light in leds) and not backend.double_links
+    stats = gateway.stats()
+    log.info("stats %s", stats)
+    log.info(
+        "%d pours, %d writes, %d leaked links, lights %s",
+        len(pours),
+        sum(light.writes for light in leds),
+        backend.double_links,
+        "in sync" if all(light.effect == want for light in leds) else "OUT OF SYNC",
+    )
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return ok
+
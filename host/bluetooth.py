@@ -0,0 +1,49 @@
+# Host-side stand-in for MicroPython's bluetooth module.
+#
+# Only UUID and the characteristic flags, enough to build and parse
+# advertising payloads on Linux. There is no radio here, so no BLE class.
+
+FLAG_BROADCAST = 0x0001
+FLAG_READ = 0x0002
+FLAG_WRITE_NO_RESPONSE = 0x0004
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+FLAG_INDICATE = 0x0020
+
+
+class UUID:
+    # Stored the way the stack does, little endian, so bytes(uuid) matches
+    # what appears in advertising data.
+    def __init__(self, value):
+        if isinstance(value, int):
+            if not 0 <= value <= 0xFFFF:
+                raise ValueError("invalid UUID")
+            self._b = value.to_bytes(2, "little")
+        elif isinstance(value, str):
+            b = bytes.fromhex(value.replace("-", ""))
+            if len(b) != 16:
+                raise ValueError("invalid UUID")
+            self._b = b[::-1]
+        else:
+            b = bytes(value)
+            if len(b) not in (2, 4, 16):
+                raise ValueError("invalid UUID")
+            self._b = b
+
+    def __bytes__(self):
+        return self._b
+
+    def __len__(self):
+        return len(self._b)
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and other._b == self._b
+
+    def __hash__(self):
+        return hash(self._b)
+
+    def __repr__(self):
+        if len(self._b) == 16:
+            h = self._b[::-1].hex()
+            return "UUID('%s-%s-%s-%s-%s')" % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+        return "UUID(0x%s)" % self._b[::-1].hex()
@@ -0,0 +1,69 @@
+# Host-side stand-in for the parts of MicroPython's machine module used here.
+
+
+class Pin:
+    # Every pin created, by id, so host scripts can reach the pins firmware
+    # code set up internally.
+    pins = {}
+
+    IN = 1
+    OUT = 3
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 2
+    IRQ_RISING = 1
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self.pull = pull
+        self._value = value or 0
+        self._handler = None
+        self._counters = []
+        Pin.pins[id] = self
+
+    def __repr__(self):
+        return "Pin(%s)" % self.id
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = 1 if v else 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def irq(self, handler=None, trigger=IRQ_FALLING, hard=False):
+        self._handler = handler
+
+    def inject(self, edges=1):
+        # Simulates a burst of falling edges: runs the IRQ handler and bumps
+        # any Counter attached to this pin once per edge.
+        for counter in self._counters:
+            counter._count += edges
+        handler = self._handler
+        if handler is not None:
+            for _ in range(edges):
+                handler(self)
+
+
+class Counter:
+    RISING = 1
+    FALLING = 2
+    UP = 1
+    DOWN = -1
+
+    def __init__(self, id, src=None, *, direction=UP, edge=RISING, filter_ns=0):
+        self.id = id
+        self._count = 0
+        if src is not None:
+            src._counters.append(self)
+
+    def value(self, value=None):
+        current = self._count
+        if value is not None:
+            self._count = value
+        return current
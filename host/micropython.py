@@ -0,0 +1,21 @@
+# Host-side stand-in for MicroPython's micropython module.
+
+
+def const(expr):
+    return expr
+
+
+def native(f):
+    return f
+
+
+def viper(f):
+    return f
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def schedule(func, arg):
+    func(arg)
@@ -0,0 +1,39 @@
+# Host-side stand-in for MicroPython's neopixel module.
+#
+# Keeps the same buf/ORDER layout as the firmware driver and records every
+# frame pushed out by write() so animations can be run and timed on Linux.
+
+
+class NeoPixel:
+    ORDER = (1, 0, 2, 3)
+
+    def __init__(self, pin, n, bpp=3, timing=1, record=True):
+        self.pin = pin
+        self.n = n
+        self.bpp = bpp
+        self.buf = bytearray(n * bpp)
+        self.timing = timing
+        self.record = record
+        self.writes = 0
+        self.frames = []
+
+    def __len__(self):
+        return self.n
+
+    def __setitem__(self, i, v):
+        offset = i * self.bpp
+        for j in range(self.bpp):
+            self.buf[offset + self.ORDER[j]] = v[j]
+
+    def __getitem__(self, i):
+        offset = i * self.bpp
+        return tuple(self.buf[offset + self.ORDER[j]] for j in range(self.bpp))
+
+    def fill(self, v):
+        for i in range(self.n):
+            self[i] = v
+
+    def write(self):
+        self.writes += 1
+        if self.record:
+            self.frames.append(bytes(self.buf))
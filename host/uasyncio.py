@@ -0,0 +1,37 @@
+# Host-side stand-in for MicroPython's uasyncio, backed by asyncio.
+
+from asyncio import *  # noqa: F401,F403
+from asyncio import Event, get_running_loop, sleep
+
+
+async def sleep_ms(t):
+    await sleep(t / 1000)
+
+
+class ThreadSafeFlag:
+    # May be set from other threads, which stand in for IRQs on the host.
+    def __init__(self):
+        self._event = Event()
+        self._loop = None
+
+    def set(self):
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            self._event.set()
+        else:
+            loop.call_soon_threadsafe(self._event.set)
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self):
+        loop = get_running_loop()
+        if loop is not self._loop:
+            # asyncio events are tied to the first loop that waits on them.
+            flagged = self._event.is_set()
+            self._event = Event()
+            if flagged:
+                self._event.set()
+            self._loop = loop
+        await self._event.wait()
+        self._event.clear()
@@ -0,0 +1,34 @@
+# Host-side stand-in for MicroPython's utime module.
+
+import time as _time
+
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALFPERIOD = _TICKS_PERIOD // 2
+
+sleep = _time.sleep
+time = _time.time
+
+
+def sleep_ms(t):
+    _time.sleep(t / 1000)
+
+
+def sleep_us(t):
+    _time.sleep(t / 1000000)
+
+
+def ticks_ms():
+    return int(_time.monotonic() * 1000) & _TICKS_MAX
+
+
+def ticks_us():
+    return int(_time.monotonic() * 1000000) & _TICKS_MAX
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + _TICKS_HALFPERIOD) & _TICKS_MAX) - _TICKS_HALFPERIOD
@@ -0,0 +1,109 @@
+# Binary command format for the LEDs characteristic.
+#
+# Shared by the light node (parsing) and the host tools (packing), so it only
+# depends on struct.
+#
+# A write is a 2 byte header followed by one or more fixed size records:
+#   header: version (B), record count (B)
+#   record: opcode (B), effect (B), r1 g1 b1 (BBB), r2 g2 b2 (BBB),
+#           period in ms (<H), brightness (B), flags (B)
+#
+# The single ASCII bytes b'0', b'1' and b'2' of the original protocol are
+# still understood as "off", "rainbow" and "pulse".
+
+import struct
+
+VERSION = 1
+
+EFFECT_OFF = 0
+EFFECT_RAINBOW = 1
+EFFECT_PULSE = 2
+# Every effect a write may select.
+EFFECTS = (EFFECT_OFF, EFFECT_RAINBOW, EFFECT_PULSE)
+
+# Switch to `effect` with the record's colours and period. All-zero colours
+# and a zero period keep the effect's defaults. Brightness is applied too if
+# FLAG_BRIGHTNESS is set.
+OP_EFFECT = 1
+# Only apply the record's brightness.
+OP_BRIGHTNESS = 2
+
+FLAG_BRIGHTNESS = 0x01
+
+HEADER_SIZE = 2
+RECORD_SIZE = 12
+MAX_RECORDS = 255
+
+# Field offsets within a record.
+F_OPCODE = 0
+F_EFFECT = 1
+F_COLORS = 2
+F_PERIOD = 8
+F_BRIGHTNESS = 10
+F_FLAGS = 11
+
+_HEADER = "<BB"
+_RECORD = "<BB6BHBB"
+
+_LEGACY = {ord('0'): EFFECT_OFF, ord('1'): EFFECT_RAINBOW, ord('2'): EFFECT_PULSE}
+
+
+def record(opcode, effect=EFFECT_OFF, c1=(0, 0, 0), c2=(0, 0, 0), period=0, brightness=None):
+    flags = 0
+    if brightness is None:
+        brightness = 0
+    else:
+        flags |= FLAG_BRIGHTNESS
+    return struct.pack(
+        _RECORD, opcode, effect, c1[0], c1[1], c1[2], c2[0], c2[1], c2[2], period, brightness, flags
+    )
+
+
+def set_effect(effect, c1=(0, 0, 0), c2=(0, 0, 0), period=0, brightness=None):
+    return record(OP_EFFECT, effect, c1, c2, period, brightness)
+
+
+def set_brightness(value):
+    return record(OP_BRIGHTNESS, brightness=value)
+
+
+def pack(*records):
+    # Batches several records into one characteristic write.
+    if not 0 < len(records) <= MAX_RECORDS:
+        raise ValueError("1 to %d records per write" % MAX_RECORDS)
+    return struct.pack(_HEADER, VERSION, len(records)) + b"".join(records)
+
+
+def is_legacy(data):
+    return len(data) == 1 and data[0] in _LEGACY
+
+
+def legacy_effect(data):
+    return _LEGACY[data[0]]
+
+
+def count(data):
+    # Number of records in a write, or -1 if it is not a well-formed command
+    # of a version we understand.
+    if len(data) < HEADER_SIZE or data[0] != VERSION:
+        return -1
+    n = data[1]
+    if n == 0 or len(data) != HEADER_SIZE + n * RECORD_SIZE:
+        return -1
+    return n
+
+
+def period(data, offset):
+    i = offset + F_PERIOD
+    return data[i] | data[i + 1] << 8
+
+
+def unpack(data):
+    # Host side helper: all records of a write as tuples. The light node reads
+    # the fields in place instead, see leds_server.handle_write.
+    n = count(data)
+    if n < 0:
+        raise ValueError("malformed command")
+    return [
+        struct.unpack_from(_RECORD, data, HEADER_SIZE + i * RECORD_SIZE) for i in range(n)
+    ]
@@ -1,11 +1,13 @@
 import uasyncio
 import machine
+import boot_log
 
 from leds_client import leds_client
 from leds_server import led_server
 
 
 async def main():
+    boot_log.mark('main')
     input = machine.Pin(13, machine.Pin.IN, machine.Pin.PULL_DOWN)
     print(input.value())
 
@@ -1,12 +1,245 @@
 import machine, neopixel
-import time
+import utime
 import uasyncio
+from array import array
+
+import boot_log
+from led_protocol import EFFECT_OFF, EFFECT_RAINBOW, EFFECT_PULSE
 
 T_STEP = 10
 
 T_DELTA = 900
 C1 = [145, 105, 0]
 C2 = [255, 230, 164]
+# Time for the rainbow to go once around the wheel.
+T_RAINBOW = 256 * T_STEP
+
+BRIGHTNESS = 255
+# Per-channel (r, g, b) gamma applied by the colour lookup tables.
+GAMMA = (2.2, 2.2, 2.2)
+
+# NeoPixel strips take their bytes in GRB order.
+_G = 0
+_R = 1
+_B = 2
+
+_MAX_RAMPS = 4
+
+# Runner effect for a strip split into segments, each with its own effect.
+_EFFECT_SEGMENTS = 255
+
+
+def wheel(pos):
+    if pos < 0 or pos > 255:
+        return (0, 0, 0)
+    if pos < 85:
+        return (255 - pos * 3, pos * 3, 0)
+    if pos < 170:
+        pos -= 85
+        return (0, 255 - pos * 3, pos * 3)
+    pos -= 170
+    return (pos * 3, 0, 255 - pos * 3)
+
+
+def calc_new_color(C1, C2, step, steps):
+    if C1 - C2 == 0:
+        return C1
+    new_color = ((C2 - C1) * step // steps) + C1
+
+    if new_color > 255:
+        return 255
+    elif new_color < 0:
+        return 0
+    return new_color
+
+
+def color_table(gamma, brightness):
+    # Maps a 0-255 channel value to its gamma-corrected, brightness-scaled
+    # output byte.
+    table = bytearray(256)
+    for i in range(256):
+        table[i] = int(((i / 255) ** gamma) * brightness + 0.5)
+    return table
+
+
+class FrameBuffer:
+    # Renders straight into the NeoPixel's own bytearray so a frame never
+    # allocates; write() just pushes the buffer out to the strip.
+    def __init__(self, np, number_of_lights):
+        self._np = np
+        self._lights = number_of_lights
+        self.buf = np.buf
+        self._mv = memoryview(self.buf)
+
+        # 256 wheel colours, 3 bytes each, already in GRB order and run
+        # through the colour tables.
+        self._wheel = bytearray(256 * 3)
+        # Ramps handed out by ramp(), rebuilt in place on brightness changes.
+        self._ramps = []
+        self.brightness = None
+        self.gamma = None
+        self.set_brightness(BRIGHTNESS)
+
+        # Wheel position of every pixel at cycle 0.
+        self._offsets = bytearray(number_of_lights)
+        for i in range(number_of_lights):
+            self._offsets[i] = (i * 256 // number_of_lights) & 255
+
+    def set_brightness(self, brightness, gamma=GAMMA):
+        # All per-frame colour math lives in these tables, so a brightness
+        # change costs one rebuild here and nothing per frame.
+        brightness = max(0, min(255, brightness))
+        if brightness == self.brightness and gamma == self.gamma:
+            return
+        self.brightness = brightness
+        self.gamma = gamma
+        self._lut_r = color_table(gamma[0], brightness)
+        self._lut_g = color_table(gamma[1], brightness)
+        self._lut_b = color_table(gamma[2], brightness)
+
+        for pos in range(256):
+            r, g, b = wheel(pos)
+            self._store(self._wheel, pos, r, g, b)
+        for ramp, c1, c2, steps in self._ramps:
+            self._build_ramp(ramp, c1, c2, steps)
+
+    def _store(self, table, index, r, g, b):
+        j = index * 3
+        table[j + _R] = self._lut_r[r]
+        table[j + _G] = self._lut_g[g]
+        table[j + _B] = self._lut_b[b]
+
+    def _build_ramp(self, ramp, c1, c2, steps):
+        for i in range(steps + 1):
+            self._store(
+                ramp,
+                i,
+                calc_new_color(c1[0], c2[0], i, steps),
+                calc_new_color(c1[1], c2[1], i, steps),
+                calc_new_color(c1[2], c2[2], i, steps),
+            )
+
+    def ramp(self, c1, c2, steps):
+        # Output bytes for every step of the c1 -> c2 interpolation, entry i
+        # being step i of steps (both ends included).
+        for ramp, r1, r2, n in self._ramps:
+            if n == steps and r1 == c1 and r2 == c2:
+                return ramp
+        ramp = bytearray((steps + 1) * 3)
+        self._build_ramp(ramp, c1, c2, steps)
+        if len(self._ramps) >= _MAX_RAMPS:
+            self._ramps.pop(0)
+        self._ramps.append((ramp, c1, c2, steps))
+        return ramp
+
+    def fill(self, r, g, b, start=0, end=None):
+        self._fill(self._lut_r[r], self._lut_g[g], self._lut_b[b], start, end)
+
+    def fill_from(self, table, index, start=0, end=None):
+        j = index * 3
+        self._fill(table[j + _R], table[j + _G], table[j + _B], start, end)
+
+    def _fill(self, r, g, b, start, end):
+        if end is None:
+            end = self._lights
+        if end <= start:
+            return
+        mv = self._mv
+        first = start * 3
+        last = end * 3
+        mv[first + _R] = r
+        mv[first + _G] = g
+        mv[first + _B] = b
+        # Double the filled region with each copy, log2(n) slice moves in total.
+        filled = 3
+        size = last - first
+        while filled < size:
+            n = min(filled, size - filled)
+            mv[first + filled:first + filled + n] = mv[first:first + n]
+            filled += n
+
+    def rainbow(self, cycle, start=0, end=None):
+        if end is None:
+            end = self._lights
+        buf = self.buf
+        table = self._wheel
+        offsets = self._offsets
+        for i in range(start, end):
+            k = ((offsets[i] + cycle) & 255) * 3
+            j = i * 3
+            buf[j] = table[k]
+            buf[j + 1] = table[k + 1]
+            buf[j + 2] = table[k + 2]
+
+    def write(self):
+        self._np.write()
+
+
+class FrameScheduler:
+    # Paces frames against absolute ticks_ms deadlines, so render and write
+    # time come out of the frame period instead of adding to it. A frame
+    # that misses its deadline is shown straight away, and whole periods
+    # that were missed are dropped rather than played late.
+    def __init__(self, period_ms):
+        self.period = period_ms
+        self._deadline = utime.ticks_ms()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.frames = 0
+        self.late = 0
+        self.dropped = 0
+        self.render_us = 0
+        self.render_max_us = 0
+        self.write_us = 0
+        self.write_max_us = 0
+        self._render_total = 0
+        self._write_total = 0
+
+    def start(self):
+        self._deadline = utime.ticks_add(utime.ticks_ms(), self.period)
+
+    def record(self, render_us, write_us):
+        self.frames += 1
+        self.render_us = render_us
+        self.write_us = write_us
+        self._render_total += render_us
+        self._write_total += write_us
+        if render_us > self.render_max_us:
+            self.render_max_us = render_us
+        if write_us > self.write_max_us:
+            self.write_max_us = write_us
+
+    async def wait(self):
+        # Returns the number of frame periods since the previous frame:
+        # 1 when on time, more when frames had to be dropped.
+        late = utime.ticks_diff(utime.ticks_ms(), self._deadline)
+        if late < 0:
+            await uasyncio.sleep_ms(-late)
+            elapsed = 1
+        else:
+            self.late += 1
+            skipped = late // self.period
+            self.dropped += skipped
+            elapsed = 1 + skipped
+            # Still yield so BLE and the other tasks get to run.
+            await uasyncio.sleep_ms(0)
+        self._deadline = utime.ticks_add(self._deadline, elapsed * self.period)
+        return elapsed
+
+    def stats(self):
+        frames = self.frames or 1
+        return {
+            'frames': self.frames,
+            'late': self.late,
+            'dropped': self.dropped,
+            'render_us': self.render_us,
+            'render_avg_us': self._render_total // frames,
+            'render_max_us': self.render_max_us,
+            'write_us': self.write_us,
+            'write_avg_us': self._write_total // frames,
+            'write_max_us': self.write_max_us,
+        }
 
 
 class Leds:
@@ -14,96 +247,241 @@ class Leds:
         self._lights = number_of_lights
         self._pin = machine.Pin(pin)
         self._np = neopixel.NeoPixel(self._pin, self._lights)
-        self._on = True
+        self._frame = FrameBuffer(self._np, self._lights)
+        self._scheduler = FrameScheduler(T_STEP)
+        self._render_start = 0
+
+        # Effect runner state, see run(). The requested effect lives in the
+        # _want* fields; _version is bumped whenever any of them changes.
+        self._effect = EFFECT_OFF
+        self._want = EFFECT_OFF
+        self._want_colors = bytearray(6)
+        self._want_period = 0
+        self._want_brightness = BRIGHTNESS
+        self._version = 0
+        self._running = 0
+        self._wake = uasyncio.ThreadSafeFlag()
+        self._task = None
+        self._first_frame = False
+        self.set_segments(1)
 
-        self.set_color(0, 255, 0)
-        time.sleep(2)
         self.set_color(0, 0, 0)
 
+    async def self_test(self, duration_ms=2000):
+        # Green for duration_ms, unless an effect is requested before or
+        # while it is shown; the runner owns the strip from then on.
+        if self._version != self._running or self._effect != EFFECT_OFF:
+            return
+        version = self._version
+        self.set_color(0, 255, 0)
+        await uasyncio.sleep_ms(duration_ms)
+        if self._version == version and self._effect == EFFECT_OFF:
+            self.set_color(0, 0, 0)
+
     def wheel(self, pos):
-        if pos < 0 or pos > 255:
-            return (0, 0, 0)
-        if pos < 85:
-            return (255 - pos * 3, pos * 3, 0)
-        if pos < 170:
-            pos -= 85
-            return (0, 255 - pos * 3, pos * 3)
-        pos -= 170
-        return (pos * 3, 0, 255 - pos * 3)
+        return wheel(pos)
 
     def set_color(self, r, g, b):
-        for i in range(self._lights):
-            self._np[i] = (r, g, b)
-        self._np.write()
+        self._frame.fill(r, g, b)
+        self._frame.write()
 
     def calc_new_color(self, C1, C2, step, steps):
-        if C1 - C2 == 0:
-            return C1
-        new_color = ((C2 - C1) * step // steps) + C1
+        return calc_new_color(C1, C2, step, steps)
 
-        if new_color > 255:
-            return new_color
-        elif new_color < 0:
-            return 0
-        return new_color
+    def set_brightness(self, brightness):
+        # The tables are rebuilt by the runner between two frames.
+        self._want_brightness = max(0, min(255, brightness))
+        self._wake.set()
 
-    # https://randomnerdtutorials.com/micropython-ws2812b-addressable-rgb-leds-neopixel-esp32-esp8266/
-    async def _rainbow_cycle(self, cycle, callback):
-        for i in range(self._lights):
-            rc_index = (i * 256 // self._lights) + cycle
-            self._np[i] = self.wheel(rc_index & 255)
-        self._np.write()
-        await uasyncio.sleep_ms(T_STEP)
-        if callback:
-            # return cycle and step
-            self._on = callback(cycle)
-
-    async def do_one_cycle(self, C1, C2, steps, cycle, callback):
-        # input step and cycle
-        for i in range(1, steps + 1):
-            if not self._on:
-                break
-
-            new_color = [0, 0, 0]
-            for j in range(3):
-                new_color[j] = self.calc_new_color(C1[j], C2[j], i, steps)
-            self.set_color(*new_color)
-            await uasyncio.sleep_ms(T_STEP)
-            if callback:
-                # return cycle and step
-                self._on = callback(cycle)
-
-    async def _do_pulse(self, C1, C2, callback):
-        steps = T_DELTA // T_STEP
-        cycle = 0
-        #do cycle in controller
-        while self._on:
-            await self.do_one_cycle(C1, C2, steps, cycle, callback)
-            C2, C1 = C1, C2
-            cycle += 1
-        self.set_color(0, 0, 0)
-        self._on = True
+    def _apply_brightness(self):
+        if self._want_brightness != self._frame.brightness:
+            self._frame.set_brightness(self._want_brightness)
 
-    async def do_rainbow(self, callback=None):
-        for i in range(254):
-            if not self._on:
-                break
-            await self._rainbow_cycle(i, callback)
+    def stats(self):
+        return self._scheduler.stats()
 
-        self.set_color(0, 0, 0)
-        self._on = True
+    def _show(self):
+        # Pushes the rendered frame out and books its render/write times.
+        rendered = utime.ticks_us()
+        self._frame.write()
+        if not self._first_frame:
+            self._first_frame = True
+            boot_log.mark('first light')
+        self._scheduler.record(
+            utime.ticks_diff(rendered, self._render_start),
+            utime.ticks_diff(utime.ticks_us(), rendered),
+        )
+
+    def start(self):
+        # Spawns the one task that ever renders to the strip.
+        if self._task is None:
+            self._task = uasyncio.create_task(self.run())
+        return self._task
+
+    def play(self, effect, colors=None, period=0, offset=0):
+        # Safe to call from BLE callbacks: only records the request, the
+        # runner picks it up at the next frame boundary. colors holds
+        # r1 g1 b1 r2 g2 b2 starting at offset, None or all zero for the
+        # defaults; period 0 is the effect's default too.
+        want = self._want_colors
+        changed = effect != self._want or period != self._want_period
+        for i in range(6):
+            c = colors[offset + i] if colors else 0
+            if c != want[i]:
+                want[i] = c
+                changed = True
+        if self._want == _EFFECT_SEGMENTS:
+            changed = True
+            for i in range(len(self._segment_effects)):
+                self._segment_effects[i] = EFFECT_OFF
+        if not changed:
+            return
+        self._want = effect
+        self._want_period = period
+        self._version += 1
+        self._wake.set()
+
+    def set_segments(self, count):
+        # Splits the strip into count equal segments, all off, for
+        # play_segment(). The whole strip effect is left alone until a
+        # segment is played.
+        count = max(1, min(count, self._lights))
+        self._bounds = array('H', [i * self._lights // count for i in range(count + 1)])
+        self._segment_effects = bytearray(count)
+        if self._want == _EFFECT_SEGMENTS:
+            self._want = EFFECT_OFF
+            self._version += 1
+            self._wake.set()
 
-    async def do_pulse(self, callback=None):
-        await self._do_pulse(C1, C2, callback)
+    def segments(self):
+        return len(self._segment_effects)
+
+    def play_segment(self, segment, effect):
+        # Segments run their effect with the default colours and period.
+        effects = self._segment_effects
+        if segment >= len(effects) or effects[segment] == effect:
+            return
+        effects[segment] = effect
+        if self._want == _EFFECT_SEGMENTS:
+            # The segment renderer picks the change up on its next frame;
+            # when the last segment goes dark the strip just switches off.
+            if any(effects):
+                return
+            self._want = EFFECT_OFF
+        else:
+            self._want = _EFFECT_SEGMENTS
+        self._version += 1
+        self._wake.set()
 
     def stop(self):
-        self._on = False
+        self.play(EFFECT_OFF)
 
+    def effect(self):
+        return self._effect
 
-if __name__ == "__main__":
+    async def run(self):
+        while True:
+            self._apply_brightness()
+            if self._version == self._running:
+                # Nothing to switch to; also swallows redundant requests.
+                await self._wake.wait()
+                continue
+            self._running = self._version
+            self._effect = self._want
+            period = self._want_period
+            if self._effect == EFFECT_RAINBOW:
+                await self._rainbow(period or T_RAINBOW)
+            elif self._effect == EFFECT_PULSE:
+                want = self._want_colors
+                if any(want):
+                    c1, c2 = (want[0], want[1], want[2]), (want[3], want[4], want[5])
+                else:
+                    c1, c2 = C1, C2
+                await self._pulse(c1, c2, period or T_DELTA)
+            elif self._effect == _EFFECT_SEGMENTS:
+                await self._segments()
+            else:
+                self._effect = EFFECT_OFF
+                self.set_color(0, 0, 0)
+
+    # https://randomnerdtutorials.com/micropython-ws2812b-addressable-rgb-leds-neopixel-esp32-esp8266/
+    async def _rainbow(self, period):
+        scheduler = self._scheduler
+        scheduler.start()
+        version = self._version
+        # Wheel position in 1/256 steps, advanced by step per frame. Under
+        # two frames per turn the wheel would stand still or turn backwards.
+        step = max(1, 65536 * T_STEP // max(period, 2 * T_STEP))
+        position = 0
+        while self._version == version:
+            self._apply_brightness()
+            self._render_start = utime.ticks_us()
+            self._frame.rainbow(position >> 8)
+            self._show()
+            # Dropped frames still advance the wheel so the speed holds.
+            position = (position + step * await scheduler.wait()) & 0xFFFF
+
+    async def _pulse(self, C1, C2, period):
+        steps = max(1, period // T_STEP)
+        ramp = self._frame.ramp(C1, C2, steps)
+        scheduler = self._scheduler
+        scheduler.start()
+        version = self._version
+        # position runs 1..2*steps: C1 -> C2 over the first half, back after.
+        position = 1
+        while self._version == version:
+            self._apply_brightness()
+            self._render_start = utime.ticks_us()
+            index = position if position <= steps else 2 * steps - position
+            self._frame.fill_from(ramp, index)
+            self._show()
+            position += await scheduler.wait()
+            while position > 2 * steps:
+                position -= 2 * steps
+
+    async def _segments(self):
+        steps = T_DELTA // T_STEP
+        ramp = self._frame.ramp(C1, C2, steps)
+        rainbow_step = max(1, 65536 * T_STEP // T_RAINBOW)
+        frame = self._frame
+        effects = self._segment_effects
+        bounds = self._bounds
+        scheduler = self._scheduler
+        scheduler.start()
+        version = self._version
+        wheel = 0
+        position = 1
+        while self._version == version:
+            self._apply_brightness()
+            self._render_start = utime.ticks_us()
+            index = position if position <= steps else 2 * steps - position
+            for i in range(len(effects)):
+                effect = effects[i]
+                if effect == EFFECT_RAINBOW:
+                    frame.rainbow(wheel >> 8, bounds[i], bounds[i + 1])
+                elif effect == EFFECT_PULSE:
+                    frame.fill_from(ramp, index, bounds[i], bounds[i + 1])
+                else:
+                    frame.fill(0, 0, 0, bounds[i], bounds[i + 1])
+            self._show()
+            elapsed = await scheduler.wait()
+            wheel = (wheel + rainbow_step * elapsed) & 0xFFFF
+            position += elapsed
+            while position > 2 * steps:
+                position -= 2 * steps
 
-    def cb(cycle):
-        return False if cycle > 200 else True
 
-    leds = Leds(60, 27)
-    uasyncio.run(leds.do_rainbow(callback=cb))
+async def demo(leds):
+    leds.start()
+    await leds.self_test(1000)
+    leds.play(EFFECT_RAINBOW)
+    await uasyncio.sleep_ms(3000)
+    leds.play(EFFECT_PULSE)
+    await uasyncio.sleep_ms(2 * T_DELTA)
+    leds.play(EFFECT_OFF)
+    await uasyncio.sleep_ms(100)
+    print(leds.stats())
+
+
+if __name__ == "__main__":
+    uasyncio.run(demo(Leds(60, 27)))
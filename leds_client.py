@@ -1,14 +1,19 @@
 # This example finds and connects to a BLE temperature sensor (e.g. the one in ble_temperature.py).
 
 import bluetooth
+import binascii
+import json
+import random
 import struct
-import time
 from micropython import const
 import machine
 import uasyncio
+import utime
 
-from ble_advertising import decode_services, decode_name
-from leds import Leds
+from ble_advertising import decode_name, find_field, has_uuid128
+import boot_log
+import flow_protocol
+from leds import Leds, EFFECT_OFF, EFFECT_RAINBOW
 
 _IRQ_CENTRAL_CONNECT = const(1)
 _IRQ_CENTRAL_DISCONNECT = const(2)
@@ -35,6 +40,8 @@ _ADV_DIRECT_IND = const(0x01)
 _ADV_SCAN_IND = const(0x02)
 _ADV_NONCONN_IND = const(0x03)
 
+_ADV_TYPE_MANUFACTURER = const(0xFF)
+
 # org.bluetooth.service.environmental_sensing
 _ENV_SENSE_UUID = bluetooth.UUID(0x181A)
 # org.bluetooth.characteristic.temperature
@@ -52,6 +59,8 @@ _FLOW_CHAR_UUID = bluetooth.UUID('f05e45d2-3352-4839-8f7a-cf950ae1f09e')
 
 # org.bluetooth.service.environmental_sensing
 _FLOW_UUID = bluetooth.UUID('cf54bd0b-3380-4b9b-b3ec-371dd8b3a7f2')
+# As it appears in advertising data, for matching in the scan IRQ.
+_FLOW_UUID_BYTES = bytes(_FLOW_UUID)
 # org.bluetooth.characteristic.temperature
 _FLOW_CHAR = (
     _FLOW_CHAR_UUID,
@@ -63,252 +72,723 @@ _FLOW_SERVICE = (
     (_FLOW_CHAR,),
 )
 
+# org.bluetooth.descriptor.gatt.client_characteristic_configuration
+_CCCD_UUID = bluetooth.UUID(0x2902)
+_CCCD_INDICATE = const(0x0002)
+# Indications only: the flow node's stack then sends every update confirmed,
+# pour start and end included. With both bits set it would notify.
+_SUBSCRIBE = struct.pack('<H', _CCCD_INDICATE)
+
 # org.bluetooth.characteristic.gap.appearance.xml
 _ADV_APPEARANCE_GENERIC_THERMOMETER = const(768)
 
+# How many flow nodes one light node follows at once. Stay within the
+# controller's connection limit (CONFIG_BT_NIMBLE_MAX_CONNECTIONS, 4 by
+# default on the ESP32).
+MAX_PEERS = const(4)
+
+# GATT handles of known flow nodes, so a reconnect can skip discovery.
+HANDLE_CACHE_PATH = 'gatt_cache.json'
+
+# Reconnect supervisor: a failed search waits BACKOFF_MIN_MS, doubling up to
+# BACKOFF_MAX_MS, plus up to half of that again as jitter. Known nodes are
+# first tried directly for CONNECT_MS before falling back to a SCAN_MS scan.
+BACKOFF_MIN_MS = 500
+BACKOFF_MAX_MS = 30000
+CONNECT_MS = 2000
+SCAN_MS = 6000
+
+# Follow flow nodes by their broadcast advertising data instead of
+# connecting. A followed node that has not been heard for FOLLOW_TIMEOUT_MS
+# is dropped; there are no connection limits, MAX_FOLLOWED only bounds the
+# strip segments.
+FOLLOW = False
+FOLLOW_TIMEOUT_MS = 10000
+MAX_FOLLOWED = const(16)
+
+# 0: quiet, 1: scan verdicts for new addresses, 2: every scan result.
+DEBUG = const(0)
+
+# Scan results remembered as flow node or not, by address.
+SCAN_CACHE_SIZE = const(32)
+_SCAN_UNKNOWN = const(0)
+_SCAN_ALLOW = const(1)
+_SCAN_DENY = const(2)
+
+
+class HandleCache:
+    # Flow service, characteristic and CCCD handles by peer address, kept in
+    # a small JSON file. Only written after a discovery, which is rare.
+    def __init__(self, path=HANDLE_CACHE_PATH):
+        self._path = path
+        try:
+            with open(path) as f:
+                self._handles = json.load(f)
+        except (OSError, ValueError):
+            self._handles = {}
+
+    def _key(self, addr):
+        return binascii.hexlify(addr).decode()
+
+    def get(self, addr):
+        # Returns (start_handle, end_handle, value_handle, cccd_handle) or
+        # None. Entries from before the CCCD was cached need a discovery.
+        handles = self._handles.get(self._key(addr))
+        if not handles or len(handles) < 5:
+            return None
+        return handles[0], handles[1], handles[2], handles[4]
+
+    def peers(self):
+        # (addr_type, addr) of every node we have handles for.
+        return [
+            (handles[3], binascii.unhexlify(key))
+            for key, handles in self._handles.items()
+            if len(handles) > 3
+        ]
+
+    def put(self, peer):
+        handles = [
+            peer.start_handle, peer.end_handle, peer.value_handle, peer.addr_type, peer.cccd_handle
+        ]
+        key = self._key(peer.addr)
+        if self._handles.get(key) != handles:
+            self._handles[key] = handles
+            self._save()
+
+    def forget(self, addr):
+        if self._handles.pop(self._key(addr), None) is not None:
+            self._save()
+
+    def _save(self):
+        try:
+            with open(self._path, 'w') as f:
+                json.dump(self._handles, f)
+        except OSError as e:
+            print('could not save handle cache', e)
+
+
+class _ScanCache:
+    # Direct mapped, fixed size table of address -> allow/deny so a crowded
+    # room's phones and beacons are rejected without parsing their adverts
+    # again. Slots are picked from the address' low bytes and the full address
+    # is compared; a clash just overwrites the older entry. Nothing here
+    # allocates, it runs in the scan IRQ.
+    def __init__(self, size=SCAN_CACHE_SIZE):
+        self._size = size
+        self._addrs = bytearray(6 * size)
+        self._verdicts = bytearray(size)
+
+    def _slot(self, addr):
+        return (addr[5] * 31 + addr[4]) % self._size
+
+    def get(self, addr):
+        slot = self._slot(addr)
+        o = slot * 6
+        addrs = self._addrs
+        for k in range(6):
+            if addrs[o + k] != addr[k]:
+                return _SCAN_UNKNOWN
+        return self._verdicts[slot]
+
+    def put(self, addr, verdict):
+        slot = self._slot(addr)
+        o = slot * 6
+        addrs = self._addrs
+        for k in range(6):
+            addrs[o + k] = addr[k]
+        self._verdicts[slot] = verdict
+
+
+class _Peer:
+    # A flow node we are connected (or connecting) to, with its discovery
+    # state, last value and the strip segment it drives.
+    def __init__(self, addr_type, addr, name):
+        self.addr_type = addr_type
+        self.addr = addr
+        self.name = name
+        self.conn_handle = None
+        self.start_handle = None
+        self.end_handle = None
+        self.value_handle = None
+        self.cccd_handle = None
+        # The node confirmed our CCCD write.
+        self.subscribed = False
+        self.segment = None
+        # Order of connection, segments are handed out in this order.
+        self.order = 0
+        # Handles came from the cache and have not been confirmed by a read.
+        self.cached = False
+        # Followed by its broadcasts: last sequence number, and when it was
+        # last heard.
+        self.seq = -1
+        self.seen = 0
+
+        # Cached value (if we have one)
+        self.value = None
+        self.rate = 0
+        self.pour_ml = 0
+        self.keg_ml = 0
+
+    def is_ready(self):
+        return self.conn_handle is not None and self.subscribed
+
+    def update_value(self, data):
+        # Data is the flow_protocol value; the pour state is the value, rate
+        # and volumes are kept alongside.
+        self.value, self.rate, self.pour_ml, self.keg_ml = flow_protocol.unpack(data)
+        return self.value
+
+    def update_broadcast(self, data, offset):
+        (
+            self.seq, self.value, self.rate, self.pour_ml, self.keg_ml
+        ) = flow_protocol.adv_unpack_from(data, offset)
+        return self.value
+
 
 class BLETemperatureCentral:
-    def __init__(self, ble):
+    def __init__(self, ble, max_peers=MAX_PEERS, handle_cache=None):
         self._ble = ble
         self._ble.active(True)
+        boot_log.mark('ble active')
         self._ble.irq(self._irq)
         self.light = Leds(60, 27)
         self.led = machine.Pin(14, machine.Pin.OUT)
-        self.led.on()
-        time.sleep(2)
-        self.led.off()
         self.led_status = False
-
-        self._reset()
-
-    def _reset(self):
-        # Cached name and address from a successful scan.
-        self._name = None
-        self._addr_type = None
-        self._addr = None
-
-        # Cached value (if we have one)
-        self._value = None
+        self.max_peers = max_peers
+        self._handle_cache = handle_cache or HandleCache()
+
+        # Connected flow nodes by conn_handle.
+        self._peers = {}
+        # Found by the scan, connection not yet up.
+        self._pending = None
+        self._scanning = False
+        # Flow nodes followed by their broadcasts, in order of discovery.
+        self._followed = []
+        self._following = False
+        self._connections = 0
+        self._scan_cache = _ScanCache()
+        self.scan_results = 0
+        self.scan_cached = 0
+
+        # Link metrics: when each address was lost, and how long getting it
+        # back took.
+        self.started = utime.ticks_ms()
+        self._lost_at = {}
+        self.reconnects = 0
+        self.last_reconnect_ms = 0
+        self.max_reconnect_ms = 0
 
         # Callbacks for completion of various operations.
         # These reset back to None after being invoked.
         self._scan_callback = None
-        self._conn_callback = None
         self._read_callback = None
 
-        # Persistent callback for when new data is notified from the device.
+        # Persistent callbacks, called with the peer concerned.
+        self._conn_callback = None
+        self._disconn_callback = None
         self._notify_callback = None
 
-        # Connected device.
-        self._conn_handle = None
-        self._start_handle = None
-        self._end_handle = None
-        self._value_handle = None
+    def _peer(self, conn_handle):
+        return self._peers.get(conn_handle)
+
+    def _known(self, addr):
+        if self._pending is not None and self._pending.addr == addr:
+            return True
+        for peer in self._peers.values():
+            if peer.addr == addr:
+                return True
+        return False
 
     def _irq(self, event, data):
         if event == _IRQ_SCAN_RESULT:
             addr_type, addr, adv_type, rssi, adv_data = data
-            print('scan_result', bytes(addr), decode_services(adv_data))
-            if adv_type in (_ADV_IND, _ADV_DIRECT_IND) and _FLOW_UUID in decode_services(
-                adv_data
+            self.scan_results += 1
+            if DEBUG > 1:
+                print('scan_result', bytes(addr), adv_type, rssi)
+            if self._following:
+                self._follow_result(addr_type, addr, adv_data)
+                return
+            if adv_type != _ADV_IND and adv_type != _ADV_DIRECT_IND:
+                # Not connectable, and scan responses don't carry the UUID.
+                return
+            verdict = self._scan_cache.get(addr)
+            if verdict == _SCAN_UNKNOWN:
+                # Broadcasting nodes have the UUID in the scan response, but
+                # their flow frame in the advert.
+                if has_uuid128(adv_data, _FLOW_UUID_BYTES) or _flow_frame(adv_data) >= 0:
+                    verdict = _SCAN_ALLOW
+                else:
+                    verdict = _SCAN_DENY
+                self._scan_cache.put(addr, verdict)
+                if DEBUG > 0:
+                    print('scan', bytes(addr), 'flow node' if verdict == _SCAN_ALLOW else 'other')
+            else:
+                self.scan_cached += 1
+            if (
+                verdict == _SCAN_ALLOW
+                and self._pending is None
+                and self.has_room()
+                and not self._known(addr)
             ):
-                # Found a potential device, remember it and stop scanning.
-                self._addr_type = addr_type
-                self._addr = bytes(
-                    addr
-                )  # Note: addr buffer is owned by caller so need to copy it.
-                self._name = decode_name(adv_data) or "?"
+                # Found a new flow node, remember it and stop scanning so we
+                # can connect to it.
+                # Note: addr buffer is owned by caller so need to copy it.
+                self._pending = _Peer(addr_type, bytes(addr), decode_name(adv_data) or "?")
                 self._ble.gap_scan(None)
 
         elif event == _IRQ_SCAN_DONE:
-            if self._scan_callback:
-                if self._addr:
-                    # Found a device during the scan (and the scan was explicitly stopped).
-                    self._scan_callback(self._addr_type, self._addr, self._name)
-                    self._scan_callback = None
-                else:
-                    # Scan timed out.
-                    self._scan_callback(None, None, None)
+            self._scanning = False
+            pending = self._pending
+            if pending is not None:
+                print("Found sensor:", pending.addr_type, pending.addr, pending.name)
+                self._ble.gap_connect(pending.addr_type, pending.addr)
+            elif self._scan_callback:
+                # Scan timed out.
+                self._scan_callback()
 
         elif event == _IRQ_PERIPHERAL_CONNECT:
             # Connect successful.
             conn_handle, addr_type, addr = data
-            if addr_type == self._addr_type and addr == self._addr:
-                self._conn_handle = conn_handle
-                self._ble.gattc_discover_services(self._conn_handle)
+            peer = self._pending
+            if peer is not None and addr_type == peer.addr_type and addr == peer.addr:
+                self._pending = None
+                peer.conn_handle = conn_handle
+                self._connections += 1
+                peer.order = self._connections
+                self._peers[conn_handle] = peer
+                handles = self._handle_cache.get(peer.addr)
+                if handles:
+                    # Known node: subscribe straight away; the handles are
+                    # confirmed by a read of the value once that is done.
+                    (
+                        peer.start_handle, peer.end_handle, peer.value_handle, peer.cccd_handle
+                    ) = handles
+                    peer.cached = True
+                    self._subscribe(peer)
+                else:
+                    self._ble.gattc_discover_services(conn_handle)
 
         elif event == _IRQ_PERIPHERAL_DISCONNECT:
             # Disconnect (either initiated by us or the remote end).
-            conn_handle, _, _ = data
-            if conn_handle == self._conn_handle:
-                # If it was initiated by us, it'll already be reset.
-                self._reset()
+            conn_handle, addr_type, addr = data
+            peer = self._peers.pop(conn_handle, None)
+            if peer is not None:
+                self._lost_at[peer.addr] = utime.ticks_ms()
+                self._assign_segments()
+                if self._disconn_callback:
+                    self._disconn_callback(peer)
+            elif self._pending is not None and addr == self._pending.addr:
+                # The connection attempt failed.
+                self._pending = None
 
         elif event == _IRQ_GATTC_SERVICE_RESULT:
             # Connected device returned a service.
             conn_handle, start_handle, end_handle, uuid = data
-            if conn_handle == self._conn_handle and uuid == _FLOW_UUID:
-                self._start_handle, self._end_handle = start_handle, end_handle
+            peer = self._peer(conn_handle)
+            if peer is not None and uuid == _FLOW_UUID:
+                peer.start_handle, peer.end_handle = start_handle, end_handle
 
         elif event == _IRQ_GATTC_SERVICE_DONE:
             # Service query complete.
-            if self._start_handle and self._end_handle:
+            conn_handle, status = data
+            peer = self._peer(conn_handle)
+            if peer is None:
+                return
+            if peer.start_handle and peer.end_handle:
                 self._ble.gattc_discover_characteristics(
-                    self._conn_handle, self._start_handle, self._end_handle
+                    conn_handle, peer.start_handle, peer.end_handle
                 )
             else:
-                print("Failed to find environmental sensing service.")
+                print("Failed to find flow service.")
+                self._ble.gap_disconnect(conn_handle)
 
         elif event == _IRQ_GATTC_CHARACTERISTIC_RESULT:
             # Connected device returned a characteristic.
             conn_handle, def_handle, value_handle, properties, uuid = data
-            if conn_handle == self._conn_handle and uuid == _FLOW_CHAR_UUID:
-                self._value_handle = value_handle
+            peer = self._peer(conn_handle)
+            if peer is not None and uuid == _FLOW_CHAR_UUID:
+                peer.value_handle = value_handle
 
         elif event == _IRQ_GATTC_CHARACTERISTIC_DONE:
             # Characteristic query complete.
-            if self._value_handle:
-                # We've finished connecting and discovering device, fire the connect callback.
-                if self._conn_callback:
-                    self._conn_callback()
+            conn_handle, status = data
+            peer = self._peer(conn_handle)
+            if peer is None:
+                return
+            if peer.value_handle:
+                # The CCCD sits between the value and the end of the service.
+                self._ble.gattc_discover_descriptors(
+                    conn_handle, peer.value_handle + 1, peer.end_handle
+                )
             else:
-                print("Failed to find temperature characteristic.")
+                print("Failed to find flow characteristic.")
+                self._ble.gap_disconnect(conn_handle)
+
+        elif event == _IRQ_GATTC_DESCRIPTOR_RESULT:
+            # Connected device returned a descriptor.
+            conn_handle, dsc_handle, uuid = data
+            peer = self._peer(conn_handle)
+            if peer is not None and peer.cccd_handle is None and uuid == _CCCD_UUID:
+                peer.cccd_handle = dsc_handle
+
+        elif event == _IRQ_GATTC_DESCRIPTOR_DONE:
+            # Descriptor query complete.
+            conn_handle, status = data
+            peer = self._peer(conn_handle)
+            if peer is None:
+                return
+            if peer.cccd_handle:
+                self._handle_cache.put(peer)
+                self._subscribe(peer)
+            else:
+                print("Failed to find flow CCCD.")
+                self._ble.gap_disconnect(conn_handle)
+
+        elif event == _IRQ_GATTC_WRITE_DONE:
+            # Only our CCCD writes ask for a response.
+            conn_handle, value_handle, status = data
+            peer = self._peer(conn_handle)
+            if peer is None or value_handle != peer.cccd_handle:
+                return
+            if status != 0:
+                if peer.cached:
+                    self._rediscover(peer)
+                else:
+                    print("Failed to subscribe to", peer.name)
+                    self._ble.gap_disconnect(conn_handle)
+                return
+            # We've finished connecting and discovering device, fire the connect callback.
+            peer.subscribed = True
+            self._ready(peer)
+            if peer.cached:
+                # Confirm the cached handles, we want the value anyway.
+                self._ble.gattc_read(conn_handle, peer.value_handle)
 
         elif event == _IRQ_GATTC_READ_RESULT:
             # A read completed successfully.
             conn_handle, value_handle, char_data = data
-            if conn_handle == self._conn_handle and value_handle == self._value_handle:
-                self._update_value(char_data)
+            peer = self._peer(conn_handle)
+            if peer is not None and value_handle == peer.value_handle:
+                if peer.cached and len(char_data) not in (flow_protocol.SIZE, 2):
+                    # Something else lives at the cached handle now.
+                    self._rediscover(peer)
+                    return
+                peer.cached = False
+                peer.update_value(char_data)
+                if self._notify_callback:
+                    self._notify_callback(peer)
                 if self._read_callback:
-                    self._read_callback(self._value)
+                    self._read_callback(peer)
                     self._read_callback = None
 
         elif event == _IRQ_GATTC_READ_DONE:
-            # Read completed (no-op).
+            # Read completed, only interesting when it failed.
             conn_handle, value_handle, status = data
+            peer = self._peer(conn_handle)
+            if status != 0 and peer is not None and peer.cached:
+                self._rediscover(peer)
 
-        elif event == _IRQ_GATTC_NOTIFY:
-            # The ble_temperature.py demo periodically notifies its value.
+        elif event == _IRQ_GATTC_NOTIFY or event == _IRQ_GATTC_INDICATE:
+            # The flow node indicates (or, to other centrals, notifies) every
+            # update; the stack confirms indications for us.
             conn_handle, value_handle, notify_data = data
-            if conn_handle == self._conn_handle and value_handle == self._value_handle:
-                self._update_value(notify_data)
+            peer = self._peer(conn_handle)
+            if peer is None:
+                return
+            if value_handle == peer.value_handle:
+                peer.update_value(notify_data)
                 if self._notify_callback:
-                    self._notify_callback(self._value)
-
-    # Returns true if we've successfully connected and discovered characteristics.
+                    self._notify_callback(peer)
+            elif peer.cached:
+                # The node's GATT database changed under our cached handles.
+                self._rediscover(peer)
+
+    def _follow_result(self, addr_type, addr, adv_data):
+        offset = _flow_frame(adv_data)
+        if offset < 0:
+            return
+        peer = None
+        for p in self._followed:
+            if p.addr == addr:
+                peer = p
+                break
+        new = peer is None
+        if new:
+            if len(self._followed) >= MAX_FOLLOWED:
+                return
+            # Note: addr buffer is owned by caller so need to copy it.
+            peer = _Peer(addr_type, bytes(addr), decode_name(adv_data) or "?")
+            self._connections += 1
+            peer.order = self._connections
+            self._followed.append(peer)
+        peer.seen = utime.ticks_ms()
+        if flow_protocol.adv_seq(adv_data, offset) == peer.seq:
+            # The same advert again.
+            return
+        peer.update_broadcast(adv_data, offset)
+        if new:
+            self._ready(peer)
+        if self._notify_callback:
+            self._notify_callback(peer)
+
+    def _ready(self, peer):
+        lost_at = self._lost_at.pop(peer.addr, None)
+        if lost_at is not None:
+            latency = utime.ticks_diff(utime.ticks_ms(), lost_at)
+            self.reconnects += 1
+            self.last_reconnect_ms = latency
+            self.max_reconnect_ms = max(self.max_reconnect_ms, latency)
+        self._assign_segments()
+        if self._conn_callback:
+            self._conn_callback(peer)
+
+    def _rediscover(self, peer):
+        print("Stale handles for", peer.name, "rediscovering")
+        self._handle_cache.forget(peer.addr)
+        peer.cached = False
+        peer.subscribed = False
+        peer.start_handle = peer.end_handle = peer.value_handle = peer.cccd_handle = None
+        self._ble.gattc_discover_services(peer.conn_handle)
+
+    def _subscribe(self, peer):
+        # Write the CCCD with a response, so we know when the node has it.
+        self._ble.gattc_write(peer.conn_handle, peer.cccd_handle, _SUBSCRIBE, 1)
+
+    def _assign_segments(self):
+        # One strip segment per ready peer, in connection order, so a single
+        # tap still gets the whole strip.
+        peers = sorted(self.peers(), key=lambda p: p.order)
+        self.light.set_segments(len(peers) or 1)
+        for i, peer in enumerate(peers):
+            peer.segment = i
+
+    async def self_test(self, duration_ms=2000):
+        # Status LED and strip light up together while we scan.
+        if not self.led_status:
+            self.led.on()
+        await self.light.self_test(duration_ms)
+        if not self.led_status:
+            self.led.off()
+
+    def peers(self):
+        return [peer for peer in self._peers.values() if peer.is_ready()] + self._followed
+
+    # Returns true if at least one flow node is connected and discovered, or
+    # followed.
     def is_connected(self):
-        return self._conn_handle is not None and self._value_handle is not None
-
-    # Find a device advertising the environmental sensor service.
-    def scan(self, callback=None):
-        self._addr_type = None
-        self._addr = None
+        if self._followed:
+            return True
+        for peer in self._peers.values():
+            if peer.is_ready():
+                return True
+        return False
+
+    def has_room(self):
+        return len(self._peers) < self.max_peers
+
+    def is_busy(self):
+        # Scanning or in the middle of connecting to a node.
+        return self._scanning or self._pending is not None
+
+    # Look for flow nodes we are not connected to yet. Connects to each one
+    # found, then carries on scanning until max_peers are connected; callback
+    # runs when a scan times out.
+    def scan(self, callback=None, duration_ms=6000):
+        if self.is_busy() or not self.has_room():
+            return False
         self._scan_callback = callback
-        self._ble.gap_scan(6000, 30000, 30000)
+        self._scanning = True
+        self._ble.gap_scan(duration_ms, 30000, 30000)
+        return True
 
-    # Connect to the specified device (otherwise use cached address from a scan).
-    def connect(self, addr_type=None, addr=None, callback=None):
-        self._addr_type = addr_type or self._addr_type
-        self._addr = addr or self._addr
-        self._conn_callback = callback
-        if self._addr_type is None or self._addr is None:
+    # Follow flow nodes by their broadcasts: a passive scan that runs until
+    # stopped, nothing is ever connected.
+    def follow(self):
+        if self.is_busy():
             return False
-        self._ble.gap_connect(self._addr_type, self._addr)
+        self._following = True
+        self._ble.gap_scan(0, 30000, 30000, False)
         return True
 
-    # Disconnect from current device.
-    def disconnect(self):
-        if not self._conn_handle:
+    # Drops followed nodes not heard for timeout_ms.
+    def expire(self, timeout_ms=FOLLOW_TIMEOUT_MS):
+        now = utime.ticks_ms()
+        lost = [p for p in self._followed if utime.ticks_diff(now, p.seen) > timeout_ms]
+        if not lost:
             return
-        self._ble.gap_disconnect(self._conn_handle)
-        self._reset()
+        for peer in lost:
+            self._followed.remove(peer)
+            self._lost_at[peer.addr] = now
+        self._assign_segments()
+        if self._disconn_callback:
+            for peer in lost:
+                self._disconn_callback(peer)
+
+    # Connect straight to a node we already know, without scanning first.
+    def connect(self, addr_type, addr, name="?", timeout_ms=CONNECT_MS):
+        if self.is_busy() or not self.has_room() or self._known(addr):
+            return False
+        self._pending = _Peer(addr_type, addr, name)
+        self._ble.gap_connect(addr_type, addr, timeout_ms)
+        return True
 
-    # Issues an (asynchronous) read, will invoke callback with data.
-    def read(self, callback):
-        if not self.is_connected():
+    def cancel_connect(self):
+        if self._pending is not None:
+            self._pending = None
+            self._ble.gap_connect(None)
+
+    def known_peers(self):
+        # Cached nodes that are not connected right now.
+        return [
+            (addr_type, addr)
+            for addr_type, addr in self._handle_cache.peers()
+            if not self._known(addr)
+        ]
+
+    def stats(self):
+        return {
+            'uptime_ms': utime.ticks_diff(utime.ticks_ms(), self.started),
+            'peers': len(self.peers()),
+            'followed': len(self._followed),
+            'reconnects': self.reconnects,
+            'last_reconnect_ms': self.last_reconnect_ms,
+            'max_reconnect_ms': self.max_reconnect_ms,
+            'scan_results': self.scan_results,
+            'scan_cached': self.scan_cached,
+        }
+
+    # Disconnect from one or all devices.
+    def disconnect(self, peer=None):
+        for p in [peer] if peer else list(self._peers.values()):
+            if p.conn_handle is not None:
+                self._ble.gap_disconnect(p.conn_handle)
+
+    # Issues an (asynchronous) read, will invoke callback with the peer.
+    def read(self, peer, callback):
+        if not peer.is_ready():
             return
         self._read_callback = callback
-        self._ble.gattc_read(self._conn_handle, self._value_handle)
+        self._ble.gattc_read(peer.conn_handle, peer.value_handle)
+
+    # Sets callbacks invoked with the peer when a flow node is connected and
+    # discovered, disconnected, or notifies us.
+    def on_connect(self, callback):
+        self._conn_callback = callback
+
+    def on_disconnect(self, callback):
+        self._disconn_callback = callback
 
-    # Sets a callback to be invoked when the device notifies us.
     def on_notify(self, callback):
         self._notify_callback = callback
 
-    def _update_value(self, data):
-        # Data is sint16 in degrees Celsius with a resolution of 0.01 degrees Celsius.
-        self._value = struct.unpack("<h", data)[0] / 100
-        return self._value
 
-    def value(self):
-        return self._value
+def _flow_frame(adv_data):
+    # Offset of a flow node's broadcast frame in adv_data, or -1.
+    offset = find_field(adv_data, _ADV_TYPE_MANUFACTURER)
+    if offset >= 0 and flow_protocol.adv_match(adv_data, offset, adv_data[offset - 2] - 1):
+        return offset
+    return -1
 
 
-async def leds_client():
+async def leds_client(follow=FOLLOW):
     ble = bluetooth.BLE()
     central = BLETemperatureCentral(ble)
+    central.light.start()
+    uasyncio.create_task(central.self_test())
+
+    def show(peer):
+        # Each flow node lights its own segment while beer is flowing.
+        light = central.light
+        if peer.segment is not None:
+            light.play_segment(peer.segment, EFFECT_RAINBOW if peer.value else EFFECT_OFF)
+        central.led_status = any(p.value for p in central.peers())
+        central.led.value(central.led_status)
+
+    def show_all(_peer=None):
+        for peer in central.peers():
+            show(peer)
+        if not central.peers():
+            central.led_status = False
+            central.led.off()
 
-    not_found = False
-    is_on = False
-
-    def on_scan(addr_type, addr, name):
-        if addr_type is not None:
-            print("Found sensor:", addr_type, addr, name)
-            central.connect()
-        else:
-            nonlocal not_found
-            not_found = True
-            print("No sensor found.")
+    def on_connect(peer):
+        print("Connected", peer.name, "segment", peer.segment)
+        boot_log.mark_once('connected')
+        # Segments were re-split, so redraw every tap.
+        show_all()
 
-    central.scan(callback=on_scan)
+    def on_notify(peer):
+        print('notify', peer.name, peer.value, peer.rate, peer.pour_ml)
+        show(peer)
 
-    # Wait for connection...
-    while not central.is_connected():
-        await uasyncio.sleep_ms(100)
-        if not_found:
-            return
+    central.on_connect(callback=on_connect)
+    central.on_disconnect(callback=show_all)
+    central.on_notify(callback=on_notify)
 
-    print("Connected")
-
-    def led_cb(_cycle):
-        return central.led_status
-
-    def on_notify(data):
-        print('notify', data)
-        nonlocal is_on
-        if data > 0 and not is_on:
-        # if data == 1 and not is_on:
-            is_on = True
-            central.led.on()
-            central.led_status = True
-            # uasyncio.create_task(central.light.do_pulse(callback=led_cb))
-            uasyncio.create_task(central.light.do_rainbow(callback=led_cb))
-        elif data == 0 and is_on:
-
-        # elif data == 0 and is_on:
-            is_on = False
-            central.led.off()
-            central.led_status = False
+    if follow:
+        await follow_broadcasts(central)
+    else:
+        await supervise(central)
 
-    def on_read(data):
-        print('read', data, data == 1)
-        if data == 1:
-            central.light.do_pulse(callback=led_cb)
-            central.led.on()
-        else:
-            central.led.off()
 
-    central.on_notify(callback=on_notify)
-    # Explicitly issue reads, using "print" as the callback.
-    # while central.is_connected():
-    #     central.read(callback=on_read)
-    #     time.sleep_ms(2000)
+async def follow_broadcasts(central):
+    # Scans passively for ever; the scan IRQ does the work, this only drops
+    # nodes that went quiet.
+    central.follow()
+    boot_log.mark('scanning')
+    while True:
+        await uasyncio.sleep_ms(1000)
+        central.expire()
 
-    # Alternative to the above, just show the most recently notified value.
-    while central.is_connected():
-    #     print(central.value())
-        await uasyncio.sleep_ms(2000)
 
-    print("Disconnected")
+async def _wait_idle(central, timeout_ms):
+    # Waits for the current scan or connection attempt to finish.
+    start = utime.ticks_ms()
+    while central.is_busy():
+        if utime.ticks_diff(utime.ticks_ms(), start) > timeout_ms:
+            central.cancel_connect()
+            return
+        await uasyncio.sleep_ms(50)
+
+
+async def supervise(central):
+    # Keeps the central connected to as many flow nodes as it can take, for
+    # ever: known nodes are reconnected directly, anything else is found by
+    # scanning. Searches that find nothing back off exponentially, with
+    # jitter so several light nodes don't retry in lockstep.
+    backoff = BACKOFF_MIN_MS
+    first_scan = True
+    while True:
+        if not central.has_room() or central.is_busy():
+            await uasyncio.sleep_ms(1000)
+            continue
+
+        peers = len(central.peers())
+        # Fast path: try the nodes we have connected to before by address.
+        for addr_type, addr in central.known_peers():
+            if central.connect(addr_type, addr):
+                await _wait_idle(central, CONNECT_MS + 1000)
+            if not central.has_room():
+                break
+
+        if central.has_room() and central.scan(duration_ms=SCAN_MS):
+            if first_scan:
+                boot_log.mark('scanning')
+                first_scan = False
+            await _wait_idle(central, SCAN_MS + CONNECT_MS + 1000)
+
+        # Discovery of a node we just connected to may still be in flight.
+        await uasyncio.sleep_ms(200)
+        if len(central.peers()) > peers:
+            backoff = BACKOFF_MIN_MS
+            print('link stats', central.stats())
+            continue
+
+        if not central.has_room():
+            continue
+        delay = backoff + backoff * random.getrandbits(8) // 512
+        backoff = min(backoff * 2, BACKOFF_MAX_MS)
+        await uasyncio.sleep_ms(delay)
 
 
 if __name__ == "__main__":
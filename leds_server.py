@@ -7,12 +7,14 @@ import bluetooth
 import struct
 import time
 import uasyncio
-from ble_advertising import advertising_payload
+from ble_advertising import advertising_payloads
 
 from micropython import const
 import machine
 import gc
+import boot_log
 from leds import Leds
+import led_protocol
 
 _IRQ_CENTRAL_CONNECT = const(1)
 _IRQ_CENTRAL_DISCONNECT = const(2)
@@ -33,6 +35,9 @@ _LEDS_CHAR = (
     _FLAG_WRITE | _FLAG_WRITE_NO_RESPONSE,
 )
 
+# Room for a batch of this many binary commands in a single write.
+_LEDS_MAX_RECORDS = const(8)
+
 _LEDS_SERVICE = (
     _LEDS_UUID,
     (_LEDS_CHAR,),
@@ -45,18 +50,23 @@ class BLELeds:
     def __init__(self, ble, number_of_leds, led_pin, name='lightpi'):
         self._ble = ble
         self._ble.active(True)
+        boot_log.mark('ble active')
         self._ble.irq(self._irq)
         ((self._handle,),) = self._ble.gatts_register_services((_LEDS_SERVICE,))
+        self._ble.gatts_set_buffer(
+            self._handle, led_protocol.HEADER_SIZE + _LEDS_MAX_RECORDS * led_protocol.RECORD_SIZE
+        )
         self._connections = set()
-        self._payload = advertising_payload(
+        self._advertised = False
+        self._adv_data, self._resp_data = advertising_payloads(
             name=name, services=[_LEDS_UUID]
         )
         self._write_callback = None
 
         self.light = Leds(number_of_leds, led_pin)
-        self.status = 0
 
         self._advertise()
+        boot_log.mark('advertising')
 
     def _irq(self, event, data):
         # Track connections so we can send notifications.
@@ -83,37 +93,62 @@ class BLELeds:
         self._write_callback = callback
 
     def _advertise(self, interval_us=500000):
-        self._ble.gap_advertise(interval_us, adv_data=self._payload)
+        # The stack keeps the last payloads, so they are only sent once.
+        if self._advertised:
+            self._ble.gap_advertise(interval_us)
+        else:
+            self._ble.gap_advertise(
+                interval_us, adv_data=self._adv_data, resp_data=self._resp_data
+            )
+            self._advertised = True
 
 
 async def led_server():
     ble = bluetooth.BLE()
     leds = BLELeds(ble, 60, 27)
+    leds.light.start()
+    uasyncio.create_task(leds.light.self_test())
     print(gc.mem_free())
 
-    def led_cb(_cycle):
-        return leds.status
-
     def handle_write(data):
-        if data == b'0':
-            status = 0
-        elif data == b'1':
-            fn = leds.light.do_rainbow
-            status = 1
-        elif data == b'2':
-            fn = leds.light.do_pulse
-            status = 1
-        leds.status = status
-
-        if status > 0:
-            uasyncio.create_task(fn(callback=led_cb))
-        gc.collect()
-        print(gc.mem_free())
+        light = leds.light
+        if led_protocol.is_legacy(data):
+            light.play(led_protocol.legacy_effect(data))
+            return
+
+        n = led_protocol.count(data)
+        if n < 0:
+            print('bad command', data)
+            return
+        # Fields are read in place, the last effect of a batch wins.
+        offset = led_protocol.HEADER_SIZE
+        for _ in range(n):
+            opcode = data[offset + led_protocol.F_OPCODE]
+            flags = data[offset + led_protocol.F_FLAGS]
+            effect = data[offset + led_protocol.F_EFFECT]
+            if opcode == led_protocol.OP_EFFECT and effect not in led_protocol.EFFECTS:
+                # Internal runner modes are not for the air.
+                print('bad effect', effect)
+                offset += led_protocol.RECORD_SIZE
+                continue
+            if opcode == led_protocol.OP_BRIGHTNESS or (
+                opcode == led_protocol.OP_EFFECT and flags & led_protocol.FLAG_BRIGHTNESS
+            ):
+                light.set_brightness(data[offset + led_protocol.F_BRIGHTNESS])
+            if opcode == led_protocol.OP_EFFECT:
+                light.play(
+                    effect,
+                    colors=data,
+                    period=led_protocol.period(data, offset),
+                    offset=offset + led_protocol.F_COLORS,
+                )
+            offset += led_protocol.RECORD_SIZE
 
     leds.on_write(callback=handle_write)
 
     while True:
         await uasyncio.sleep_ms(1000)
+        gc.collect()
 
 if __name__ == "__main__":
     uasyncio.run(led_server())
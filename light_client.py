@@ -0,0 +1,116 @@
+# Host side client for the light nodes' LEDs characteristic, on top of
+# bleak's BleakClient.
+#
+# The characteristic is found by UUID, never by its position in the service
+# table, and its handle is kept per device address in a small JSON file. A
+# connection is opened once and reused for any number of commands, each of
+# which is a single write; it is reopened on demand if the link drops.
+
+import asyncio
+import json
+import os
+
+from bleak import BleakClient
+
+import led_protocol
+
+LIGHT_SERVICE = "f281c95f-3947-4879-b851-08c11d22f085"
+LIGHT_CHAR = "3c110d21-b7a4-4115-889a-77a03fdbcda3"
+
+HANDLE_CACHE_PATH = os.path.expanduser("~/.cache/taplight/gatt_handles.json")
+
+
+class HandleCache:
+    # {address: {characteristic uuid: handle}} in a JSON file, only written
+    # when a handle changes.
+    def __init__(self, path=HANDLE_CACHE_PATH):
+        self._path = path
+        try:
+            with open(path) as f:
+                self._handles = json.load(f)
+        except (OSError, ValueError):
+            self._handles = {}
+
+    def get(self, address, uuid):
+        return self._handles.get(address.upper(), {}).get(uuid)
+
+    def put(self, address, uuid, handle):
+        handles = self._handles.setdefault(address.upper(), {})
+        if handles.get(uuid) != handle:
+            handles[uuid] = handle
+            self._save()
+
+    def forget(self, address):
+        if self._handles.pop(address.upper(), None) is not None:
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        tmp = self._path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._handles, f)
+        os.replace(tmp, self._path)
+
+
+class LightClient:
+    def __init__(self, address, handle_cache=None, timeout=10.0):
+        self.address = address
+        self._cache = handle_cache or HandleCache()
+        self._timeout = timeout
+        self._client = None
+        self._char = None
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def is_connected(self):
+        return self._client is not None and self._client.is_connected
+
+    async def connect(self):
+        if self.is_connected():
+            return
+        client = BleakClient(self.address, timeout=self._timeout)
+        await client.connect()
+        self._client = client
+        self._char = self._resolve()
+
+    def _resolve(self):
+        # bleak has the service table once connected (BlueZ keeps its own
+        # copy between connections); the cached handle is used if it still
+        # points at the LEDs characteristic, so a reflashed node with a
+        # different layout is noticed and re-cached.
+        services = self._client.services
+        handle = self._cache.get(self.address, LIGHT_CHAR)
+        char = services.get_characteristic(handle) if handle is not None else None
+        if char is None or char.uuid.lower() != LIGHT_CHAR:
+            char = services.get_characteristic(LIGHT_CHAR)
+            if char is None:
+                self._cache.forget(self.address)
+                raise LookupError("{} has no LEDs characteristic".format(self.address))
+            self._cache.put(self.address, LIGHT_CHAR, char.handle)
+        return char
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.disconnect()
+            self._client = None
+            self._char = None
+
+    async def send(self, *records, response=True):
+        # One write for any number of records. With response, the write is
+        # confirmed by the node: still one round trip.
+        command = led_protocol.pack(*records)
+        async with self._lock:
+            await self.connect()
+            await self._client.write_gatt_char(self._char, command, response=response)
+
+    async def set_effect(self, effect, c1=(0, 0, 0), c2=(0, 0, 0), period=0, brightness=None):
+        await self.send(led_protocol.set_effect(effect, c1, c2, period, brightness))
+
+    async def set_brightness(self, value):
+        await self.send(led_protocol.set_brightness(value))
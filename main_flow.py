@@ -4,14 +4,14 @@
 # any connected central every 10 seconds.
 
 import bluetooth
-import struct
-import time
-from ble_advertising import advertising_payload
+from ble_advertising import advertising_payloads
 import uasyncio
-from flow import flow
+from flow import flow, FlowMeter, Journal, POUR_END
+import flow_protocol
 
 from micropython import const
 import machine
+import boot_log
 
 _IRQ_CENTRAL_CONNECT = const(1)
 _IRQ_CENTRAL_DISCONNECT = const(2)
@@ -35,17 +35,41 @@ _FLOW_SERVICE = (
 )
 
 
+# Also broadcast the flow value in the advertising data, so light nodes can
+# follow the tap by scanning instead of connecting. Adverts go out faster
+# while beer is flowing.
+BROADCAST = True
+ADV_INTERVAL_US = 500000
+ADV_POURING_US = 100000
+
+# Holding the keg switch for this long starts counting a new keg.
+KEG_RESET_MS = 2000
+_SWITCH_POLL_MS = const(100)
+
+
 class BLEBeerFlow:
-    def __init__(self, ble, name="beerflow"):
+    def __init__(self, ble, name="beerflow", broadcast=BROADCAST):
         self._ble = ble
         self._ble.active(True)
+        boot_log.mark('ble active')
         self._ble.irq(self._irq)
         ((self._handle,),) = self._ble.gatts_register_services((_FLOW_SERVICE,))
-        self._connections = set()
-        self._payload = advertising_payload(
-            name=name, services=[_FLOW_UUID]
+        self.indications_failed = 0
+        self._value = bytearray(flow_protocol.SIZE)
+        self._name = name
+        self._broadcast = broadcast
+        self._seq = 0
+        self._interval_us = ADV_INTERVAL_US
+        self._advertised = False
+        self._adv_data, self._resp_data = advertising_payloads(
+            name=name,
+            services=[_FLOW_UUID],
+            manufacturer=flow_protocol.adv_pack(0, flow_protocol.STATE_IDLE, 0, 0, 0)
+            if broadcast
+            else None,
         )
         self._advertise()
+        boot_log.mark('advertising')
 
         self.switch = machine.Pin(27, machine.Pin.IN, machine.Pin.PULL_DOWN)
         self.pulses = 0
@@ -53,54 +77,102 @@ class BLEBeerFlow:
     # org.bluetooth.characteristic.gap.appearance.xml
 
     def _irq(self, event, data):
-        # Track connections so we can send notifications.
-        if event == _IRQ_CENTRAL_CONNECT:
-            conn_handle, _, _ = data
-            self._connections.add(conn_handle)
-        elif event == _IRQ_CENTRAL_DISCONNECT:
-            conn_handle, _, _ = data
-            self._connections.remove(conn_handle)
+        if event == _IRQ_CENTRAL_DISCONNECT:
             # Start advertising again to allow a new connection.
             self._advertise()
         elif event == _IRQ_GATTS_INDICATE_DONE:
             conn_handle, value_handle, status = data
+            if status != 0:
+                self.indications_failed += 1
+                print('indication not confirmed', conn_handle, status)
+
+    def set_flow(self, state, rate=0, pour_ml=0, keg_ml=0, notify=False):
+        # Write the local value, ready for a central to read. With notify,
+        # the stack also sends it to every central that subscribed, as its
+        # CCCD asked: a notification, or a confirmed indication for centrals
+        # that subscribed to indications only. NimBLE keeps the CCCDs to
+        # itself, so this is the one way to honour them there.
+        flow_protocol.pack_into(self._value, state, rate, pour_ml, keg_ml)
+        self._ble.gatts_write(self._handle, self._value, notify)
+        if self._broadcast:
+            self._broadcast_flow(state, rate, pour_ml, keg_ml)
+
+    def set_keg(self, keg_ml):
+        # Publishes the current value again with a new keg volume.
+        state, rate, pour_ml, _ = flow_protocol.unpack(self._value)
+        self.set_flow(state, rate, pour_ml, keg_ml, notify=True)
+
+    def _broadcast_flow(self, state, rate, pour_ml, keg_ml):
+        # A new sequence number tells followers this is an update and not
+        # the same advert heard again.
+        self._seq = (self._seq + 1) & 0xFF
+        self._adv_data, self._resp_data = advertising_payloads(
+            name=self._name,
+            services=[_FLOW_UUID],
+            manufacturer=flow_protocol.adv_pack(self._seq, state, rate, pour_ml, keg_ml),
+        )
+        self._interval_us = (
+            ADV_POURING_US if state == flow_protocol.STATE_POURING else ADV_INTERVAL_US
+        )
+        self._advertised = False
+        self._advertise()
 
-    def set_flow(self, flow, notify=False, indicate=False):
-        # Data is sint16 in degrees Celsius with a resolution of 0.01 degrees Celsius.
-        # Write the local value, ready for a central to read.
-        #self._ble.gatts_write(self._handle, struct.pack("<h", int(flow * 100)))
-        self._ble.gatts_write(self._handle, struct.pack("<h", int(flow)))
-        if notify or indicate:
-            for conn_handle in self._connections:
-                if notify:
-                    # Notify connected centrals.
-                    self._ble.gatts_notify(conn_handle, self._handle)
-                if indicate:
-                    # Indicate connected centrals.
-                    self._ble.gatts_indicate(conn_handle, self._handle)
-
-    def _advertise(self, interval_us=500000):
-        self._ble.gap_advertise(interval_us, adv_data=self._payload)
+    def _advertise(self):
+        # The stack keeps the last payloads, so they are only sent when they
+        # changed.
+        if self._advertised:
+            self._ble.gap_advertise(self._interval_us)
+        else:
+            self._ble.gap_advertise(
+                self._interval_us, adv_data=self._adv_data, resp_data=self._resp_data
+            )
+            self._advertised = True
 
 
 def handle_pulse_factory(ble_flow):
-    def handle_pulse(pulses):
-        if pulses != ble_flow.pulses:
-            ble_flow.set_flow(1, notify=True, indicate=False)
-            ble_flow.pulses = pulses
-        else:
-            ble_flow.set_flow(0, notify=True, indicate=False)
+    # Every pour event carries the current rate and volumes; the detector
+    # already limits how often they come.
+    def handle_pulse(event, meter):
+        ble_flow.pulses = meter.pulses()
+        state = flow_protocol.STATE_IDLE if event == POUR_END else flow_protocol.STATE_POURING
+        ble_flow.set_flow(
+            state, meter.smoothed_rate, meter.pour_ml(), meter.keg_ml(), notify=True
+        )
 
     return handle_pulse
 
+async def watch_keg_switch(ble_flow, meter, journal, hold_ms=KEG_RESET_MS):
+    # Once per press held for hold_ms, the keg volume starts again from 0.
+    # The new keg is journaled and published straight away.
+    held = 0
+    while True:
+        await uasyncio.sleep_ms(_SWITCH_POLL_MS)
+        if not ble_flow.switch.value():
+            held = 0
+            continue
+        held += _SWITCH_POLL_MS
+        if held - _SWITCH_POLL_MS < hold_ms <= held:
+            meter.reset_keg()
+            journal.save(meter, force=True)
+            print('new keg')
+            ble_flow.set_keg(meter.keg_ml())
+
+
+async def run(ble_flow, meter, journal):
+    uasyncio.create_task(watch_keg_switch(ble_flow, meter, journal))
+    await flow(handle_pulse_factory(ble_flow), meter, journal=journal, restore=False)
+
+
 def main():
-    print('starting')
+    boot_log.mark('main')
     ble = bluetooth.BLE()
     ble_flow = BLEBeerFlow(ble)
-    uasyncio.run(flow(handle_pulse_factory(ble_flow)))
-
-    while True:
-        time.sleep(1)
+    meter = FlowMeter()
+    journal = Journal()
+    # Publish the restored keg volume now rather than after the first pour.
+    journal.restore(meter)
+    ble_flow.set_flow(flow_protocol.STATE_IDLE, keg_ml=meter.keg_ml())
+    uasyncio.run(run(ble_flow, meter, journal))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
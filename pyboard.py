@@ -71,6 +71,11 @@ import sys
 import time
 import os
 import ast
+import binascii
+import hashlib
+import select
+import struct
+import threading
 
 try:
     stdout = sys.stdout.buffer
@@ -79,12 +84,62 @@ except AttributeError:
     stdout = sys.stdout
 
 
+# When several boards run at once, each worker thread sets _output.writer
+# to a _PrefixedOutput and everything it prints goes through that.
+_output = threading.local()
+_output_lock = threading.Lock()
+
+
 def stdout_write_bytes(b):
     b = b.replace(b"\x04", b"")
+    writer = getattr(_output, "writer", None)
+    if writer is not None:
+        writer.write(b.decode("utf-8", "replace"))
+        return
     stdout.write(b)
     stdout.flush()
 
 
+class _PrefixedOutput:
+    # Writes whole lines, each starting with the device name, so output of
+    # boards running in parallel doesn't interleave mid-line.
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
+        self._partial = ""
+
+    def write(self, text):
+        lines = (self._partial + text.replace("\r\n", "\n")).split("\n")
+        self._partial = lines.pop()
+        if lines:
+            with _output_lock:
+                for line in lines:
+                    self._stream.write("%s: %s\n" % (self._prefix, line))
+                self._stream.flush()
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._partial:
+            self.write("\n")
+
+
+class _ThreadRoutedStdout:
+    # Stands in for sys.stdout so print() in worker threads is prefixed too.
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, text):
+        writer = getattr(_output, "writer", None)
+        return (writer or self._stream).write(text)
+
+    def flush(self):
+        writer = getattr(_output, "writer", None)
+        (writer or self._stream).flush()
+
+
 class PyboardError(Exception):
     pass
 
@@ -135,10 +190,11 @@ class TelnetToSerial:
                     break
                 timeout_count += 1
 
-        data = b""
-        while len(data) < size and len(self.fifo) > 0:
-            data += bytes([self.fifo.popleft()])
-        return data
+        popleft = self.fifo.popleft
+        return bytes(popleft() for _ in range(min(size, len(self.fifo))))
+
+    def fileno(self):
+        return self.tn.fileno()
 
     def write(self, data):
         self.tn.write(data)
@@ -191,19 +247,33 @@ class ProcessToSerial:
     def read(self, size=1):
         data = b""
         while len(data) < size:
-            data += self.subp.stdout.read(size - len(data))
+            new_data = self.subp.stdout.read(size - len(data))
+            if not new_data:
+                raise PyboardError("process exited")
+            data += new_data
         return data
 
     def write(self, data):
         self.subp.stdin.write(data)
         return len(data)
 
+    def fileno(self):
+        return self.subp.stdout.fileno()
+
     def inWaiting(self):
         # res = self.sel.select(0)
         res = self.poll.poll(0)
-        if res:
-            return 1
-        return 0
+        if not res:
+            return 0
+        try:
+            import fcntl
+            import termios
+
+            n = struct.unpack("i", fcntl.ioctl(self.fileno(), termios.FIONREAD, b"\0" * 4))[0]
+        except (ImportError, OSError):
+            n = 0
+        # Readable with nothing buffered means end of file, let read() see it.
+        return max(n, 1)
 
 
 class ProcessPtyToTerminal:
@@ -247,6 +317,9 @@ class ProcessPtyToTerminal:
     def write(self, data):
         return self.ser.write(data)
 
+    def fileno(self):
+        return self.ser.fileno()
+
     def inWaiting(self):
         return self.ser.inWaiting()
 
@@ -257,6 +330,18 @@ class Pyboard:
     ):
         self.in_raw_repl = False
         self.use_raw_paste = True
+        # Bytes read_until received past the ending it was looking for.
+        self._pending = bytearray()
+        # Whether _fs_helper_code has been run since entering the raw REPL,
+        # and whether the device can run it at all.
+        self._fs_helper = False
+        self.use_fs_helper = True
+        # Bytes fs_put may have in flight before the device acknowledges
+        # them; by default the raw-paste window the device reported, as that
+        # is what its stdin buffer takes (about 256 bytes on an ESP32) and
+        # anything past it is dropped.
+        self.fs_window = None
+        self.paste_window = None
         if device.startswith("exec:"):
             self.serial = ProcessToSerial(device[len("exec:") :])
         elif device.startswith("execpty:"):
@@ -296,36 +381,84 @@ class Pyboard:
     def close(self):
         self.serial.close()
 
+    def _read(self, size):
+        # Reads exactly size bytes, starting with any read_until left over.
+        if not self._pending:
+            return self.serial.read(size)
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        if len(data) < size:
+            data += self.serial.read(size - len(data))
+        return data
+
+    def _in_waiting(self):
+        return len(self._pending) + self.serial.inWaiting()
+
+    def _wait_readable(self, timeout):
+        # Blocks until the device has sent something or timeout seconds (None
+        # for ever) have passed. Channels without a file descriptor (e.g.
+        # serial ports on Windows) are polled instead.
+        try:
+            fd = self.serial.fileno()
+        except (AttributeError, OSError, ValueError):
+            fd = None
+        if fd is not None:
+            select.select([fd], [], [], timeout)
+        else:
+            time.sleep(0.01 if timeout is None else min(timeout, 0.01))
+
     def read_until(self, min_num_bytes, ending, timeout=10, data_consumer=None):
         # if data_consumer is used then data is not accumulated and the ending must be 1 byte long
         assert data_consumer is None or len(ending) == 1
 
-        data = self.serial.read(min_num_bytes)
-        if data_consumer:
-            data_consumer(data)
-        timeout_count = 0
+        # Reads whatever the device has sent so far in one go. Only the newly
+        # read bytes (plus enough to catch an ending split across reads) are
+        # searched, and anything after the ending is kept for the next read.
+        # timeout is in seconds of silence from the device.
+        data = bytearray()
+        new_data = self._read(min_num_bytes)
+        search = 0
+        deadline = None
         while True:
-            if data.endswith(ending):
-                break
-            elif self.serial.inWaiting() > 0:
-                new_data = self.serial.read(1)
+            if new_data:
                 if data_consumer:
+                    i = new_data.find(ending)
+                    if i >= 0:
+                        self._pending[0:0] = new_data[i + 1 :]
+                        new_data = new_data[: i + 1]
                     data_consumer(new_data)
                     data = new_data
+                    if i >= 0:
+                        break
                 else:
-                    data = data + new_data
-                timeout_count = 0
-            else:
-                timeout_count += 1
-                if timeout is not None and timeout_count >= 100 * timeout:
-                    break
-                time.sleep(0.01)
-        return data
+                    data += new_data
+                    i = data.find(ending, search)
+                    if i >= 0:
+                        i += len(ending)
+                        self._pending[0:0] = data[i:]
+                        del data[i:]
+                        break
+                    search = max(0, len(data) - len(ending) + 1)
+                if timeout is not None:
+                    deadline = time.monotonic() + timeout
+            n = self._in_waiting()
+            if n:
+                new_data = self._read(n)
+                continue
+            new_data = b""
+            if deadline is None and timeout is not None:
+                deadline = time.monotonic() + timeout
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            self._wait_readable(remaining)
+        return bytes(data)
 
     def enter_raw_repl(self, soft_reset=True):
         self.serial.write(b"\r\x03\x03")  # ctrl-C twice: interrupt any running program
 
         # flush input (without relying on serial.flushInput())
+        del self._pending[:]
         n = self.serial.inWaiting()
         while n > 0:
             self.serial.read(n)
@@ -355,6 +488,7 @@ class Pyboard:
             raise PyboardError("could not enter raw repl")
 
         self.in_raw_repl = True
+        self._fs_helper = False
 
     def exit_raw_repl(self):
         self.serial.write(b"\r\x02")  # ctrl-B: enter friendly REPL
@@ -378,15 +512,16 @@ class Pyboard:
 
     def raw_paste_write(self, command_bytes):
         # Read initial header, with window size.
-        data = self.serial.read(2)
+        data = self._read(2)
         window_size = data[0] | data[1] << 8
         window_remain = window_size
+        self.paste_window = window_size
 
         # Write out the command_bytes data.
         i = 0
         while i < len(command_bytes):
-            while window_remain == 0 or self.serial.inWaiting():
-                data = self.serial.read(1)
+            while window_remain == 0 or self._in_waiting():
+                data = self._read(1)
                 if data == b"\x01":
                     # Device indicated that a new window of data can be sent.
                     window_remain += window_size
@@ -425,7 +560,7 @@ class Pyboard:
         if self.use_raw_paste:
             # Try to enter raw-paste mode.
             self.serial.write(b"\x05A\x01")
-            data = self.serial.read(2)
+            data = self._read(2)
             if data == b"R\x00":
                 # Device understood raw-paste command but doesn't support it.
                 pass
@@ -448,7 +583,7 @@ class Pyboard:
         self.serial.write(b"\x04")
 
         # check if we could exec command
-        data = self.serial.read(2)
+        data = self._read(2)
         if data != b"OK":
             raise PyboardError("could not exec command (response: %r)" % data)
 
@@ -491,7 +626,99 @@ class Pyboard:
         )
         self.exec_(cmd, data_consumer=stdout_write_bytes)
 
+    def _load_fs_helper(self):
+        # Defines the transfer functions on the device, once per raw REPL
+        # session. Returns False if the device can't run them.
+        if not self._fs_helper and self.use_fs_helper:
+            try:
+                self.exec_(_fs_helper_code)
+                self._fs_helper = True
+            except PyboardError:
+                self.use_fs_helper = False
+        return self._fs_helper
+
+    def _fs_start(self, command):
+        # Runs a transfer function and waits for it to be ready (ACK); if it
+        # failed instead, raise with its output.
+        self.exec_raw_no_follow(command)
+        self._fs_ack()
+
+    def _fs_finish(self, crc, size):
+        # The device ends with its own CRC32 and byte count.
+        ret, ret_err = self.follow(10)
+        if ret_err:
+            raise PyboardError("exception", ret, ret_err)
+        if ret.split() != [str(crc).encode(), str(size).encode()]:
+            raise PyboardError("exception", ret, b"transfer check failed\r\n")
+
     def fs_get(self, src, dest, chunk_size=256):
+        # Streams the file in one exec: ACK, 4 byte length, raw contents,
+        # then the device's CRC32 for the whole file.
+        if not self._load_fs_helper():
+            return self._fs_get_repr(src, dest, chunk_size)
+        self._fs_start("_pb_get('%s',%u)" % (src, max(chunk_size, 1024)))
+        (size,) = struct.unpack("<I", self._read(4))
+        crc = 0
+        with open(dest, "wb") as f:
+            remaining = size
+            while remaining:
+                data = self._read(min(remaining, 65536))
+                crc = binascii.crc32(data, crc)
+                f.write(data)
+                remaining -= len(data)
+        self._fs_finish(crc, size)
+
+    def fs_put(self, src, dest, chunk_size=256):
+        # Streams the file in one exec as length prefixed raw chunks, with at
+        # most fs_window bytes ahead of the device's ACKs (one per chunk),
+        # then a zero length and the device's CRC32 for the whole file.
+        if not self._load_fs_helper():
+            return self._fs_put_repr(src, dest, chunk_size)
+        window = self.fs_window or self.paste_window or 256
+        # At least two frames fit the window, so the next one is already
+        # waiting in the device's stdin while it writes the previous one.
+        chunk_size = max(1, min(chunk_size, window // 2 - 2))
+        with open(src, "rb") as f:
+            data = f.read()
+        self._fs_start("_pb_put('%s',%u)" % (dest, chunk_size))
+        in_flight = []
+        try:
+            for i in range(0, len(data), chunk_size):
+                frame = struct.pack("<H", min(chunk_size, len(data) - i)) + data[i : i + chunk_size]
+                while in_flight and sum(in_flight) + len(frame) > window:
+                    self._fs_ack()
+                    in_flight.pop(0)
+                self.serial.write(frame)
+                in_flight.append(len(frame))
+            # The end marker is not acknowledged but needs room all the same.
+            while in_flight and sum(in_flight) + 2 > window:
+                self._fs_ack()
+                in_flight.pop(0)
+            self.serial.write(b"\x00\x00")
+            for _ in in_flight:
+                self._fs_ack()
+        except PyboardError:
+            # The device gave up part way; drop whatever of ours it has
+            # not read yet from the raw REPL's input.
+            self.serial.write(b"\x03")
+            raise
+        self._fs_finish(binascii.crc32(data), len(data))
+
+    def _fs_ack(self, timeout=10):
+        # Waits for the device's ACK; anything else is its traceback.
+        deadline = time.monotonic() + timeout
+        while not self._in_waiting():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PyboardError("timeout waiting for the device to acknowledge a transfer")
+            self._wait_readable(remaining)
+        data = self._read(1)
+        if data != b"\x06":
+            self._pending[0:0] = data
+            ret, ret_err = self.follow(10)
+            raise PyboardError("exception", ret, ret_err)
+
+    def _fs_get_repr(self, src, dest, chunk_size=256):
         self.exec_("f=open('%s','rb')\nr=f.read" % src)
         with open(dest, "wb") as f:
             while True:
@@ -509,7 +736,7 @@ class Pyboard:
                 f.write(data)
         self.exec_("f.close()")
 
-    def fs_put(self, src, dest, chunk_size=256):
+    def _fs_put_repr(self, src, dest, chunk_size=256):
         self.exec_("f=open('%s','wb')\nw=f.write" % dest)
         with open(src, "rb") as f:
             while True:
@@ -522,6 +749,73 @@ class Pyboard:
                     self.exec_("w(" + repr(data) + ")")
         self.exec_("f.close()")
 
+    def fs_hashes(self, dir):
+        # {path: sha256 hex} of every file under dir on the device, in one exec.
+        hashes = {}
+        ret = self.exec_(_fs_hash_code + "_pb_hash('%s')" % dir)
+        for line in ret.decode().splitlines():
+            digest, _, path = line.partition(" ")
+            if path:
+                hashes[path] = digest
+        return hashes
+
+    def fs_sync(self, src, dest, delete=False, mpy=None):
+        # Makes the device directory dest match the local directory src,
+        # copying only files whose SHA-256 differs and, if asked, removing
+        # device code (.py, .mpy) that is not in src; data the nodes write
+        # themselves, like the flow journal, is left alone. Returns (copied,
+        # unchanged, deleted) lists of device paths.
+        #
+        # With mpy (an MpyCross), modules are sent compiled: x.py goes up as
+        # x.mpy from the compiler's cache. boot.py and main.py stay source,
+        # MicroPython only runs them as .py.
+        local = {}
+        for root, dirs, files in os.walk(src):
+            dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != "__pycache__")
+            for name in sorted(files):
+                if name.startswith("."):
+                    continue
+                path = source = os.path.join(root, name)
+                rel = os.path.relpath(path, src).replace(os.sep, "/")
+                if mpy is not None and rel.endswith(".py") and name not in ("boot.py", "main.py"):
+                    path = mpy.compile(source, rel)
+                    rel = rel[:-3] + ".mpy"
+                with open(path, "rb") as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+                local[_remote_join(dest, rel)] = (source, path, digest)
+        remote = self.fs_hashes(dest)
+
+        copy = [r for r, (_, _, digest) in local.items() if remote.get(r) != digest]
+        unchanged = [r for r in local if r not in copy]
+        if delete:
+            stale = sorted(r for r in remote if r not in local and r.endswith((".py", ".mpy")))
+        else:
+            # The other form of a module being sent always goes: a leftover
+            # x.py would be imported instead of the new x.mpy.
+            stale = sorted(r for r in remote if r not in local and _module_twin(r) in local)
+
+        # Every directory the copies need, parents first, in one exec.
+        dirs = set()
+        for r in copy:
+            parts = r.split("/")[:-1]
+            for i in range(1, len(parts) + 1):
+                d = "/".join(parts[:i])
+                if d:
+                    dirs.add(d)
+        if dirs:
+            self.exec_(
+                "import uos\nfor d in %r:\n try:uos.mkdir(d)\n except OSError:pass"
+                % sorted(dirs, key=len)
+            )
+        for r in copy:
+            print("sync %s :%s" % (local[r][0], r))
+            self.fs_put(local[r][1], r)
+        if stale:
+            for r in stale:
+                print("sync rm :%s" % r)
+            self.exec_("import uos\nfor f in %r:\n uos.remove(f)" % stale)
+        return copy, unchanged, stale
+
     def fs_mkdir(self, dir):
         self.exec_("import uos\nuos.mkdir('%s')" % dir)
 
@@ -546,7 +840,80 @@ def execfile(filename, device="/dev/ttyACM0", baudrate=115200, user="micro", pas
     pyb.close()
 
 
-def filesystem_command(pyb, args):
+def _remote_join(dir, name):
+    if not dir:
+        return name
+    return dir.rstrip("/") + "/" + name
+
+
+def _module_twin(path):
+    # x.py <-> x.mpy
+    if path.endswith(".py"):
+        return path[:-3] + ".mpy"
+    if path.endswith(".mpy"):
+        return path[:-4] + ".py"
+    return None
+
+
+class MpyCross:
+    # Compiles .py to .mpy with mpy-cross on the host. Output is cached by the
+    # SHA-256 of the compiler version, its options, the module name and the
+    # source, so an unchanged module is never compiled twice, whichever tree
+    # or board it is deployed from. command may carry options, like
+    # "mpy-cross -O1"; version is None if the compiler cannot be run.
+    def __init__(self, command="mpy-cross", cache_dir=None):
+        import shlex
+
+        self._command = shlex.split(command)
+        self._cache_dir = cache_dir or os.environ.get(
+            "PYBOARD_MPY_CACHE", os.path.expanduser("~/.cache/pyboard/mpy")
+        )
+        self._lock = threading.Lock()
+        self.version = self._version()
+
+    def _version(self):
+        import subprocess
+
+        try:
+            ret = subprocess.run(
+                self._command[:1] + ["--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+        except OSError:
+            return None
+        if ret.returncode != 0:
+            return None
+        return ret.stdout.decode("utf-8", "replace").strip()
+
+    def compile(self, path, name):
+        # Returns the path of the cached .mpy for the source file at path;
+        # name is the module's path on the device, as shown in tracebacks.
+        import subprocess
+
+        with open(path, "rb") as f:
+            source = f.read()
+        key = hashlib.sha256()
+        for part in (self.version, " ".join(self._command[1:]), name):
+            key.update(part.encode("utf-8") + b"\0")
+        key.update(source)
+        out = os.path.join(self._cache_dir, key.hexdigest() + ".mpy")
+        # Boards synced in parallel share the cache; one compile per module.
+        with self._lock:
+            if os.path.exists(out):
+                return out
+            os.makedirs(self._cache_dir, exist_ok=True)
+            tmp = out + ".tmp"
+            ret = subprocess.run(
+                self._command + ["-s", name, "-o", tmp, path],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+            if ret.returncode != 0:
+                raise PyboardError("exception", b"", ret.stdout)
+            os.replace(tmp, out)
+        return out
+
+
+def filesystem_command(pyb, args, delete=False, mpy=None):
     def fname_remote(src):
         if src.startswith(":"):
             src = src[1:]
@@ -565,7 +932,14 @@ def filesystem_command(pyb, args):
     cmd = args[0]
     args = args[1:]
     try:
-        if cmd == "cp":
+        if cmd == "sync":
+            src, dest = args
+            copied, unchanged, deleted = pyb.fs_sync(src, fname_remote(dest), delete, mpy)
+            print(
+                "sync: %d copied, %d unchanged, %d deleted"
+                % (len(copied), len(unchanged), len(deleted))
+            )
+        elif cmd == "cp":
             srcs = args[:-1]
             dest = args[-1]
             if srcs[0].startswith("./") or dest.startswith(":"):
@@ -601,6 +975,81 @@ def filesystem_command(pyb, args):
         sys.exit(1)
 
 
+# Prints "sha256 path" for every file under a directory, for fs_sync.
+_fs_hash_code = """\
+import uos, uhashlib, ubinascii
+def _pb_hash(d):
+  b = bytearray(512)
+  m = memoryview(b)
+  try:
+    entries = list(uos.ilistdir(d))
+  except OSError:
+    return
+  for e in entries:
+    p = d.rstrip('/') + '/' + e[0] if d else e[0]
+    if e[1] & 0x4000:
+      _pb_hash(p)
+      continue
+    h = uhashlib.sha256()
+    with open(p, 'rb') as f:
+      while 1:
+        n = f.readinto(b)
+        if not n:
+          break
+        h.update(m[:n])
+    print(ubinascii.hexlify(h.digest()).decode(), p)
+"""
+
+
+# Transfer functions for fs_put and fs_get. Data goes over the raw REPL's
+# stdin and stdout as raw bytes, so Ctrl-C is disabled while it does.
+_fs_helper_code = """\
+import sys, micropython, ubinascii, uos
+def _pb_rd(i, m):
+  k = 0
+  while k < len(m):
+    k += i.readinto(m[k:])
+def _pb_put(name, n):
+  i = sys.stdin.buffer
+  o = sys.stdout.buffer
+  m = memoryview(bytearray(n))
+  h = memoryview(bytearray(2))
+  c = s = 0
+  with open(name, 'wb') as f:
+    micropython.kbd_intr(-1)
+    try:
+      o.write(b'\\x06')
+      while 1:
+        _pb_rd(i, h)
+        l = h[0] | h[1] << 8
+        if not l:
+          break
+        _pb_rd(i, m[:l])
+        f.write(m[:l])
+        c = ubinascii.crc32(m[:l], c)
+        s += l
+        o.write(b'\\x06')
+    finally:
+      micropython.kbd_intr(3)
+  print(c, s)
+def _pb_get(name, n):
+  o = sys.stdout.buffer
+  m = memoryview(bytearray(n))
+  c = s = 0
+  with open(name, 'rb') as f:
+    o.write(b'\\x06')
+    o.write(uos.stat(name)[6].to_bytes(4, 'little'))
+    while 1:
+      l = f.readinto(m)
+      if not l:
+        break
+      o.write(m[:l])
+      c = ubinascii.crc32(m[:l], c)
+      s += l
+  print(c, s)
+"""
+
+
 _injected_import_hook_code = """\
 import uos, uio
 class _FS:
@@ -636,8 +1085,16 @@ def main():
     cmd_parser.add_argument(
         "-d",
         "--device",
-        default=os.environ.get("PYBOARD_DEVICE", "/dev/ttyACM0"),
-        help="the serial device or the IP address of the pyboard",
+        action="append",
+        help="the serial device or the IP address of the pyboard; may be given more than once "
+        "and may be a glob like /dev/ttyUSB* to run on several boards at once",
+    )
+    cmd_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=8,
+        help="boards to talk to at the same time when there are several [default 8]",
     )
     cmd_parser.add_argument(
         "-b",
@@ -696,22 +1153,110 @@ def main():
         "--filesystem",
         action="store_true",
         help="perform a filesystem action: "
-        "cp local :device | cp :device local | cat path | ls [path] | rm path | mkdir path | rmdir path",
+        "cp local :device | cp :device local | cat path | ls [path] | rm path | mkdir path | rmdir path"
+        " | sync localdir :devicedir",
+    )
+    cmd_parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="with -f sync, remove device .py/.mpy files that are not in the local directory",
+    )
+    cmd_parser.add_argument(
+        "--mpy",
+        action="store_true",
+        help="with -f sync, send modules compiled to .mpy by mpy-cross (cached); "
+        "plain .py if mpy-cross is not available",
+    )
+    cmd_parser.add_argument(
+        "--mpy-cross",
+        default=os.environ.get("MPY_CROSS", "mpy-cross"),
+        help="the mpy-cross command, with any options, e.g. 'mpy-cross -O1' [default mpy-cross]",
     )
     cmd_parser.add_argument("files", nargs="*", help="input files")
     args = cmd_parser.parse_args()
 
+    # One compiler, and one cache, for every board.
+    args.mpy_compiler = None
+    if args.mpy:
+        args.mpy_compiler = MpyCross(args.mpy_cross)
+        if args.mpy_compiler.version is None:
+            print("note: %s not found, sending .py files" % args.mpy_cross)
+            args.mpy_compiler = None
+
+    devices = expand_devices(args.device or [os.environ.get("PYBOARD_DEVICE", "/dev/ttyACM0")])
+    if not devices:
+        print("no device matches", " ".join(args.device))
+        sys.exit(1)
+    if len(devices) == 1:
+        run_device(args, devices[0])
+    else:
+        sys.exit(run_devices(args, devices))
+
+
+def expand_devices(patterns):
+    # Globs are expanded (sorted), anything else is used as given.
+    import glob
+
+    devices = []
+    for pattern in patterns:
+        if any(c in pattern for c in "*?[") and not pattern.startswith(("exec:", "execpty:")):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        for device in matches:
+            if device not in devices:
+                devices.append(device)
+    return devices
+
+
+def run_devices(args, devices):
+    # Runs the same action on every board from a thread pool, output
+    # prefixed by device, then prints a summary. Returns the exit code.
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(device):
+        writer = _PrefixedOutput(device, sys.__stdout__)
+        _output.writer = writer
+        try:
+            run_device(args, device)
+            return 0
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print("error:", e)
+            return 1
+        finally:
+            writer.close()
+            _output.writer = None
+
+    real_stdout = sys.stdout
+    sys.stdout = _ThreadRoutedStdout(real_stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            codes = list(pool.map(run, devices))
+    finally:
+        sys.stdout = real_stdout
+
+    failed = [(device, code) for device, code in zip(devices, codes) if code]
+    print("%d of %d boards succeeded" % (len(devices) - len(failed), len(devices)))
+    for device, code in failed:
+        print("  failed: %s (exit code %d)" % (device, code))
+    return 1 if failed else 0
+
+
+def run_device(args, device):
+    # args is shared by every board's thread, so it is only read here.
+    files = list(args.files)
+
     # open the connection to the pyboard
     try:
-        pyb = Pyboard(
-            args.device, args.baudrate, args.user, args.password, args.wait, args.exclusive
-        )
+        pyb = Pyboard(device, args.baudrate, args.user, args.password, args.wait, args.exclusive)
     except PyboardError as er:
         print(er)
         sys.exit(1)
 
     # run any command or file(s)
-    if args.command is not None or args.filesystem or len(args.files):
+    if args.command is not None or args.filesystem or len(files):
         # we must enter raw-REPL mode to execute commands
         # this will do a soft-reset of the board
         try:
@@ -744,15 +1289,15 @@ def main():
 
         # do filesystem commands, if given
         if args.filesystem:
-            filesystem_command(pyb, args.files)
-            del args.files[:]
+            filesystem_command(pyb, files, args.delete, args.mpy_compiler)
+            files = []
 
         # run the command, if given
         if args.command is not None:
             execbuffer(args.command.encode("utf-8"))
 
         # run any files
-        for filename in args.files:
+        for filename in files:
             with open(filename, "rb") as f:
                 pyfile = f.read()
                 if filename.endswith(".mpy") and pyfile[0] == ord("M"):
@@ -764,7 +1309,7 @@ def main():
         pyb.exit_raw_repl()
 
     # if asked explicitly, or no files given, then follow the output
-    if args.follow or (args.command is None and not args.filesystem and len(args.files) == 0):
+    if args.follow or (args.command is None and not args.filesystem and len(files) == 0):
         try:
             ret, ret_err = pyb.follow(timeout=None, data_consumer=stdout_write_bytes)
         except PyboardError as er:
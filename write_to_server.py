@@ -1,22 +1,99 @@
+# Sends effect commands to a light node.
+#
+#   python write_to_server.py [-a ADDRESS] COMMAND [; COMMAND ...]
+#   python write_to_server.py [-a ADDRESS]        (commands from stdin)
+#
+# Commands:
+#   off
+#   rainbow [PERIOD_MS]
+#   pulse [R,G,B [R,G,B [PERIOD_MS]]]
+#   brightness 0-255
+#
+# Commands separated by ';' go out together in one write. Without commands on
+# the command line it keeps the connection open and sends one write per line
+# read from stdin, so it can sit behind a pipe or a FIFO as a daemon.
+
+import argparse
 import asyncio
-from bleak import BleakClient
+import struct
+import sys
+
+import led_protocol
+from light_client import LightClient
 
 address = "CBC59304-2DE7-4A5B-BF0E-120BC9AA429B"
-LIGHT_CHAR = "3c110d21-b7a4-4115-889a-77a03fdbcda3"
-LIGHT_SERVICES = "f281c95f-3947-4879-b851-08c11d22f085"
-
-async def main(address):
-    async with BleakClient(address) as client:
-        services = await client.get_services()
-        print('services', services.get_characteristic(LIGHT_CHAR))
-        print('char', services.characteristics[20].service_uuid)
-        print('servicehandle', services.characteristics[20].service_handle)
-        print('serviceuuid', services.characteristics[20].service_uuid)
-        print('charuuid', services.characteristics[20].uuid)
-        print('charhandle', services.characteristics[20].handle)
-        print('props', services.characteristics[20].properties)
-        await client.write_gatt_char(services.characteristics[20], bytearray(b'0'))
-        print('write done')
-        await asyncio.sleep(2)
-
-asyncio.run(main(address))
\ No newline at end of file
+
+_EFFECTS = {
+    "off": led_protocol.EFFECT_OFF,
+    "rainbow": led_protocol.EFFECT_RAINBOW,
+    "pulse": led_protocol.EFFECT_PULSE,
+}
+
+
+def _color(word):
+    r, g, b = (int(v) for v in word.split(","))
+    return r, g, b
+
+
+def _record(name, args):
+    if name == "brightness" and len(args) == 1:
+        return led_protocol.set_brightness(int(args[0]))
+    if name == "rainbow" and len(args) <= 1:
+        period = int(args[0]) if args else 0
+        return led_protocol.set_effect(led_protocol.EFFECT_RAINBOW, period=period)
+    if name in _EFFECTS and len(args) <= 3:
+        c1 = _color(args[0]) if len(args) > 0 else (0, 0, 0)
+        c2 = _color(args[1]) if len(args) > 1 else (0, 0, 0)
+        period = int(args[2]) if len(args) > 2 else 0
+        return led_protocol.set_effect(_EFFECTS[name], c1, c2, period)
+    return None
+
+
+def parse(line):
+    # Returns the led_protocol records for one line of commands. Anything
+    # that can't be sent, including out of range values, is a ValueError.
+    records = []
+    for command in line.split(";"):
+        words = command.split()
+        if not words:
+            continue
+        try:
+            record = _record(words[0].lower(), words[1:])
+        except (ValueError, struct.error) as e:
+            raise ValueError("bad command: {} ({})".format(command.strip(), e))
+        if record is None:
+            raise ValueError("unknown command: {}".format(command.strip()))
+        records.append(record)
+    return records
+
+
+async def _lines():
+    loop = asyncio.get_running_loop()
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            return
+        yield line
+
+
+async def main(address, command=None):
+    async with LightClient(address) as light:
+        if command:
+            await light.send(*parse(command))
+            return
+        async for line in _lines():
+            try:
+                records = parse(line)
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                continue
+            if records:
+                await light.send(*records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--address", default=address)
+    parser.add_argument("command", nargs="*")
+    args = parser.parse_args()
+    asyncio.run(main(args.address, " ".join(args.command)))